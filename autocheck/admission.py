@@ -0,0 +1,119 @@
+"""
+Admission control for uploads: how often each student may use the
+checker, and how many trials may be waiting or running at once.
+
+Each student (by author and by repository, as given in the uploaded
+credentials) and each client address has a bucket of tokens.  A
+bucket holds at most "burst" tokens and is refilled at "per_hour"
+tokens an hour; a submission takes one token from each of its
+buckets.  Separately, at most max_in_flight trials may be queued or
+running.  A submission that would overdraw a bucket or exceed that
+cap is refused, with the number of seconds after which a retry can
+succeed, before any work is done for it.
+
+State is kept in one JSON file shared by all worker processes (see
+shared.py).  Trials in flight are held in the name of their job and
+let go by release() when the job finishes; a hold that is never
+released (e.g., the process died) lapses after IN_FLIGHT_SECONDS.
+"""
+
+import math
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+ADMISSION_FILE = "/tmp/,admission/admission.json"
+STUDENT_BURST = 5
+STUDENT_PER_HOUR = 20
+ADDRESS_BURST = 10
+ADDRESS_PER_HOUR = 60
+MAX_IN_FLIGHT = 20
+IN_FLIGHT_SECONDS = 3600
+BUSY_RETRY = 30    # Seconds to suggest when too many trials are in flight
+
+
+def buckets_for(settings, author, repo, address):
+    """The buckets a submission draws on, as (key, burst, per_hour)
+    triples, with limits from settings (e.g., app.config) or else the
+    defaults above.  A burst of 0 turns that limit off.
+    """
+    student = (settings.get("STUDENT_BURST", STUDENT_BURST),
+               settings.get("STUDENT_PER_HOUR", STUDENT_PER_HOUR))
+    per_address = (settings.get("ADDRESS_BURST", ADDRESS_BURST),
+                   settings.get("ADDRESS_PER_HOUR", ADDRESS_PER_HOUR))
+    buckets = [("author:" + author,) + student,
+               ("repo:" + repo,) + student,
+               ("address:" + address,) + per_address]
+    return [bucket for bucket in buckets if bucket[1]]
+
+
+def admit(holder, buckets, max_in_flight=MAX_IN_FLIGHT,
+          state_file=ADMISSION_FILE):
+    """Admit a submission by holder (e.g., its job ID) if every bucket
+    has a token and fewer than max_in_flight trials are in flight;
+    if so, take the tokens, hold a place in flight, and return None.
+    Otherwise take nothing and return (seconds, reason): when to try
+    again, and which limit refused it.
+    """
+    now = time.time()
+    with shared.updating(state_file, {}) as state:
+        tokens = state.setdefault("buckets", {})
+        in_flight = state.setdefault("in_flight", {})
+        for other, since in list(in_flight.items()):
+            if since + IN_FLIGHT_SECONDS < now:
+                del in_flight[other]
+        refusals = []
+        levels = {}
+        for key, burst, per_hour in buckets:
+            level = _level(tokens.get(key), burst, per_hour, now)
+            levels[key] = level
+            if level < 1:
+                wait = math.ceil((1 - level) * 3600 / per_hour) \
+                    if per_hour else IN_FLIGHT_SECONDS
+                refusals.append((wait, key.split(":")[0]))
+        if max_in_flight and len(in_flight) >= max_in_flight:
+            refusals.append((BUSY_RETRY, "in_flight"))
+        if refusals:
+            return max(refusals)
+        for key, burst, per_hour in buckets:
+            tokens[key] = {"tokens": levels[key] - 1, "updated": now}
+        in_flight[holder] = now
+        _forget_full(tokens, buckets, now)
+    return None
+
+
+def release(holder, state_file=ADMISSION_FILE):
+    """holder's trial is no longer in flight."""
+    with shared.updating(state_file, {}) as state:
+        state.get("in_flight", {}).pop(holder, None)
+
+
+def in_flight(state_file=ADMISSION_FILE):
+    """Number of trials now queued or running."""
+    return len(shared.read_json(state_file, {}).get("in_flight", {}))
+
+
+def _level(bucket, burst, per_hour, now):
+    """Tokens in a bucket (a dict, or None if it was full) at now."""
+    if bucket is None:
+        return burst
+    refill = (now - bucket["updated"]) * per_hour / 3600
+    return min(burst, bucket["tokens"] + refill)
+
+
+def _forget_full(tokens, buckets, now):
+    """Drop buckets that have refilled, so the file stays small; a
+    missing bucket is a full one.
+    """
+    limits = {key: (burst, per_hour) for key, burst, per_hour in buckets}
+    for key, bucket in list(tokens.items()):
+        burst, per_hour = limits.get(key, (None, None))
+        if burst is None:
+            # Limits not at hand; assume an hour refills anything
+            if now - bucket["updated"] > 3600:
+                del tokens[key]
+        elif _level(bucket, burst, per_hour, now) >= burst:
+            del tokens[key]
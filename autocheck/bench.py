@@ -0,0 +1,490 @@
+"""
+Load benchmark: how many trials the checker gets through, and where
+the time goes.
+
+Usage (from the autocheck directory):
+   python3 bench.py -n 20 -c 4
+Options:
+   -n N              trials to run in all (default 20)
+   -c N              concurrent clients (default 4)
+   --mode trial      call trial.trial directly, N clients at once
+   --mode async      run trial.trial_async, N at once in one event loop
+   --mode upload     submit through /_upload and wait for each job,
+                     as students do; in process, unless --url is given
+   --url URL         base URL of a running checker (upload mode only;
+                     its admission limits apply)
+   --scenarios ...   which synthetic repositories to use (default all)
+   -C config.ini     grader configuration
+   --json FILE       also write the report as JSON, to compare runs
+   --keep            keep the fixture repositories (path is logged)
+
+Everything runs offline.  The benchmark builds a small synthetic
+student repository for each scenario, as a file:// remote:
+   clean            page server that passes every check
+   failing_install  'make install' fails
+   style_errors     passes its tests, fails the style check
+   slow_start       server takes a few seconds to listen
+   hung_server      server accepts connections and never answers
+Trials cycle through the scenarios; all run fresh (the result cache
+is bypassed) and are shut down when done.  In upload mode identical
+submissions may be attached to one job, so throughput counts the
+distinct jobs run, not the submissions.  The report gives, for
+each stage and for the whole trial, latency percentiles; throughput;
+how many trials of each scenario came out as they should; and the
+peak resident memory of this process and of its largest child.  The
+exit status is 1 if any trial came out otherwise.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import config
+import grade
+import trial
+
+import logging
+log = logging.getLogger(__name__)
+
+PROJECT = "proj1:pageserver"
+SLOW_START = 4      # Seconds, within the probe_seconds default of 10
+POLL_SECONDS = 0.2
+
+_SERVER = '''\
+"""Page server for benchmarking the checker."""
+
+import http.server
+import os
+import sys
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if ".." in self.path:
+            code, body = 403, b"Forbidden"
+        else:
+            path = os.path.join("..", "sample_site", self.path.lstrip("/"))
+            if os.path.isfile(path):
+                code = 200
+                with open(path, "rb") as page:
+                    body = page.read()
+            else:
+                code, body = 404, b"Not found"
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1])
+    http.server.ThreadingHTTPServer(("", port), Handler).serve_forever()
+'''
+
+_SLOPPY_SERVER = _SERVER.replace("import http.server\nimport os\nimport sys",
+                                 "import http.server,os,sys") \
+                        .replace("\n\n\nclass", "\nclass")
+
+_HUNG_SERVER = '''\
+"""Accepts connections, never answers."""
+
+import socket
+import sys
+import time
+
+listener = socket.socket()
+listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+listener.bind(("", int(sys.argv[1])))
+listener.listen(16)
+held = []
+while True:
+    connection, _ = listener.accept()
+    held.append(connection)
+'''
+
+_START = '''\
+#!/bin/bash
+{delay}cd pageserver
+exec python3 server.py "$2"
+'''
+
+_MAKEFILE = "install:\n\t@echo Installed\n"
+_FAILING_MAKEFILE = ("install:\n\t@echo Building wheel for nonexistent-package"
+                     "\n\t@exit 1\n")
+
+# Scenario: (files of the repository, stage results we expect)
+SCENARIOS = {
+    "clean": ({"pageserver/server.py": _SERVER},
+              {"ok": True}),
+    "failing_install": ({"pageserver/server.py": _SERVER,
+                         "Makefile": _FAILING_MAKEFILE},
+                        {"install": False}),
+    "style_errors": ({"pageserver/server.py": _SLOPPY_SERVER},
+                     {"stylecheck": False, "testit": True}),
+    "slow_start": ({"pageserver/server.py": _SERVER,
+                    "start.sh": _START.format(
+                        delay="sleep {}\n".format(SLOW_START))},
+                   {"ok": True}),
+    "hung_server": ({"pageserver/server.py": _HUNG_SERVER},
+                    {"testit": False}),
+}
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(
+        description="CIS 322 Auto-Checker: load benchmark")
+    parser.add_argument("-n", "--trials", type=int, default=20,
+                        help="Number of trials in all")
+    parser.add_argument("-c", "--clients", type=int, default=4,
+                        help="Number of concurrent clients")
+    parser.add_argument("--mode", choices=["trial", "async", "upload"],
+                        default="trial",
+                        help="Call trial.trial or trial.trial_async,"
+                        " or go through /_upload")
+    parser.add_argument("--url", default=None,
+                        help="Base URL of a running checker (upload mode)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS),
+                        default=list(SCENARIOS),
+                        help="Synthetic repositories to use")
+    parser.add_argument("-C", "--config", default="config.ini",
+                        help="Grader configuration file")
+    parser.add_argument("--json", default=None,
+                        help="Also write the report to this JSON file")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the fixture repositories")
+    return parser.parse_args()
+
+
+def make_fixtures(root, scenarios):
+    """Create a git repository and a credentials file under root for
+    each scenario.  Returns a dict from scenario to credentials path.
+    """
+    credentials = {}
+    for name in scenarios:
+        files, _ = SCENARIOS[name]
+        repo = os.path.join(root, name)
+        contents = {"Makefile": _MAKEFILE,
+                    "start.sh": _START.format(delay="")}
+        contents.update(files)
+        for path, text in contents.items():
+            full_path = os.path.join(repo, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "w") as f:
+                f.write(text)
+        git = ["git", "-c", "user.name=bench",
+               "-c", "user.email=bench@localhost"]
+        for args in (["init", "-q"], ["add", "-A"],
+                     ["commit", "-q", "-m", "Benchmark fixture"]):
+            subprocess.check_output(git + args, cwd=repo,
+                                    stderr=subprocess.STDOUT)
+        credentials[name] = os.path.join(root, name + ".ini")
+        with open(credentials[name], "w") as f:
+            f.write("[DEFAULT]\nauthor = bench-{}\nrepo = file://{}\n"
+                    .format(name, repo))
+    return credentials
+
+
+def run_trial(credentials):
+    """One trial through trial.trial, shut down afterward.  Returns
+    (ok, stages, seconds).
+    """
+    return asyncio.run(run_trial_async(credentials))
+
+
+async def run_trial_async(credentials):
+    """One trial through trial.trial_async, shut down afterward."""
+    proj, app = PROJECT.split(":")
+    context = {"credentials": credentials, "messages": "",
+               "project": proj, "app": app, "fresh": True,
+               "job_id": "bench-" + uuid.uuid4().hex[:12]}
+    started = time.time()
+    try:
+        ok = await trial.trial_async(context)
+    finally:
+        seconds = time.time() - started
+        if context.get("port"):
+            await trial.shutdown_async(context)
+        elif "clone_path" in context:
+            await asyncio.to_thread(trial.release,
+                                    trial.lease_holder(context))
+    return ok, context.get("stages", {}), seconds
+
+
+async def run_all_async(credentials, scenarios, trials, clients):
+    """All trials in this thread's event loop, clients at a time.
+    Returns the results, as from one_result.
+    """
+    slots = asyncio.Semaphore(clients)
+
+    async def one(i):
+        scenario = scenarios[i % len(scenarios)]
+        async with slots:
+            try:
+                outcome = await run_trial_async(credentials[scenario])
+            except Exception as e:
+                log.error("Trial %s (%s) raised %s", i, scenario, e)
+                return one_result(scenario, error=e)
+        return one_result(scenario, *outcome)
+
+    return await asyncio.gather(*[one(i) for i in range(trials)])
+
+
+def one_result(scenario, ok=False, stages=None, seconds=0.0, job_id=None,
+               error=None):
+    """Result of one trial, as report() takes them."""
+    stages = stages or {}
+    return {"scenario": scenario, "ok": ok, "stages": stages,
+            "seconds": seconds, "job_id": job_id,
+            "error": None if error is None else str(error),
+            "as_expected": error is None and expected(scenario, ok, stages)}
+
+
+class _LocalClient:
+    """Requests to the grader in this process (flask test client)."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def upload(self, credentials):
+        with open(credentials, "rb") as f:
+            response = self.client.post(
+                "/_upload", content_type="multipart/form-data",
+                data={"project": PROJECT, "fresh": "on",
+                      "cfgfile": (f, os.path.basename(credentials))})
+        return response.status_code, response.headers
+
+    def get_json(self, path):
+        return self.client.get(path).get_json()
+
+    def get(self, path):
+        self.client.get(path)
+
+
+class _RemoteClient:
+    """Requests to a running grader over HTTP."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        # The session cookie says which trials we may shut down
+        self.cookies = urllib.request.HTTPCookieProcessor()
+
+    def upload(self, credentials):
+        boundary = uuid.uuid4().hex
+        with open(credentials, "rb") as f:
+            content = f.read()
+        body = b"".join([
+            "--{}\r\nContent-Disposition: form-data; name=\"project\""
+            "\r\n\r\n{}\r\n".format(boundary, PROJECT).encode(),
+            "--{}\r\nContent-Disposition: form-data; name=\"fresh\""
+            "\r\n\r\non\r\n".format(boundary).encode(),
+            "--{}\r\nContent-Disposition: form-data; name=\"cfgfile\";"
+            " filename=\"{}\"\r\nContent-Type: text/plain\r\n\r\n"
+            .format(boundary, os.path.basename(credentials)).encode(),
+            content, "\r\n--{}--\r\n".format(boundary).encode()])
+        request = urllib.request.Request(
+            self.url + "/_upload", data=body,
+            headers={"Content-Type":
+                     "multipart/form-data; boundary=" + boundary})
+        opener = urllib.request.build_opener(_NoRedirect, self.cookies)
+        try:
+            response = opener.open(request)
+            return response.status, response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers
+
+    def get_json(self, path):
+        opener = urllib.request.build_opener(self.cookies)
+        with opener.open(self.url + path) as response:
+            return json.load(response)
+
+    def get(self, path):
+        opener = urllib.request.build_opener(self.cookies)
+        with opener.open(self.url + path) as response:
+            response.read()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def upload_trial(client, credentials):
+    """One trial through /_upload, waiting for the job to finish and
+    then shutting it down.  Returns (ok, stages, seconds, job_id); the
+    job may be one an identical submission started.
+    """
+    started = time.time()
+    while True:
+        code, headers = client.upload(credentials)
+        if code != 429:
+            break
+        time.sleep(int(headers.get("Retry-After", 1)))
+    location = headers.get("Location", "")
+    if code != 302 or "/job/" not in location:
+        raise RuntimeError("Upload refused with status {}".format(code))
+    job_id = location.rstrip("/").rsplit("/", 1)[1]
+    while True:
+        status = client.get_json("/_status/" + job_id)
+        if status["status"] in ("done", "error"):
+            break
+        time.sleep(POLL_SECONDS)
+    seconds = time.time() - started
+    client.get("/_kill?job=" + job_id)
+    return status["ok"], status.get("stages") or {}, seconds, job_id
+
+
+def expected(scenario, ok, stages):
+    """Did a trial of scenario come out as it should?"""
+    for name, want in SCENARIOS[scenario][1].items():
+        got = ok if name == "ok" else stages.get(name, {}).get("ok")
+        if bool(got) != want:
+            return False
+    return True
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values (not empty)."""
+    ordered = sorted(values)
+    rank = math.ceil(fraction * len(ordered)) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def report(results, elapsed, clients):
+    """Summary of the results (list of dicts) as a dict.  Submissions
+    attached to the same job count as one trial run, and its stages
+    are timed once.
+    """
+    latencies = {name: [] for name in grade.STAGE_NAMES + ["trial"]}
+    outcomes = {}
+    jobs_seen = set()
+    runs = 0
+    for result in results:
+        latencies["trial"].append(result["seconds"])
+        attached = result["job_id"] in jobs_seen
+        if result["job_id"] is not None:
+            jobs_seen.add(result["job_id"])
+        runs += not attached
+        for name, outcome in result["stages"].items():
+            if not attached and outcome.get("ok") is not None:
+                latencies.setdefault(name, []).append(outcome["seconds"])
+        counts = outcomes.setdefault(result["scenario"],
+                                     {"trials": 0, "as_expected": 0,
+                                      "errors": 0})
+        counts["trials"] += 1
+        counts["as_expected"] += result["as_expected"]
+        counts["errors"] += result["error"] is not None
+    summary = {"trials": runs, "submissions": len(results),
+               "clients": clients, "seconds": elapsed,
+               "throughput": runs / elapsed if elapsed else None,
+               "scenarios": outcomes, "latency": {}}
+    for name, values in latencies.items():
+        if values:
+            summary["latency"][name] = {
+                "n": len(values),
+                "p50": percentile(values, 0.50),
+                "p90": percentile(values, 0.90),
+                "p99": percentile(values, 0.99),
+                "max": max(values)}
+    summary["peak_rss_mb"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024
+    summary["peak_child_rss_mb"] = resource.getrusage(
+        resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return summary
+
+
+def print_report(summary):
+    print("{} trials in {:.1f} seconds with {} clients: {:.2f} trials/s"
+          .format(summary["trials"], summary["seconds"], summary["clients"],
+                  summary["throughput"] or 0))
+    if summary["submissions"] != summary["trials"]:
+        print("({} submissions; the others were attached to a trial"
+              " already running)".format(summary["submissions"]))
+    print()
+    print("{:<16} {:>5} {:>8} {:>8} {:>8} {:>8}".format(
+        "latency (s)", "n", "p50", "p90", "p99", "max"))
+    for name, stats in summary["latency"].items():
+        print("{:<16} {:>5} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+            name, stats["n"], stats["p50"], stats["p90"], stats["p99"],
+            stats["max"]))
+    print()
+    for name, counts in summary["scenarios"].items():
+        print("{:<16} {}/{} as expected{}".format(
+            name, counts["as_expected"], counts["trials"],
+            ", {} errors".format(counts["errors"]) if counts["errors"]
+            else ""))
+    print()
+    print("Peak RSS: {:.0f} MB in this process, {:.0f} MB largest child"
+          .format(summary["peak_rss_mb"], summary["peak_child_rss_mb"]))
+
+
+def main():
+    args = command_line_args()
+    settings = grade.settings_from(args.config)
+    config.configure_logging(settings)
+    trial.configure(settings)
+    root = tempfile.mkdtemp(prefix=",bench.")
+    credentials = make_fixtures(root, args.scenarios)
+    log.info("Fixture repositories in %s", root)
+
+    if args.mode == "upload" and args.url:
+        clients = [_RemoteClient(args.url) for _ in range(args.clients)]
+    elif args.mode == "upload":
+        import flask_grader   # Starts its own trial workers
+        flask_grader.app.config.update(STUDENT_BURST=0, ADDRESS_BURST=0,
+                                       MAX_IN_FLIGHT=0)
+        clients = [_LocalClient(flask_grader.app)
+                   for _ in range(args.clients)]
+    idle = list(range(args.clients))
+    idle_lock = threading.Lock()
+
+    def one(i):
+        scenario = args.scenarios[i % len(args.scenarios)]
+        with idle_lock:
+            slot = idle.pop()
+        try:
+            if args.mode == "upload":
+                outcome = upload_trial(clients[slot], credentials[scenario])
+            else:
+                outcome = run_trial(credentials[scenario])
+        except Exception as e:
+            log.error("Trial %s (%s) raised %s", i, scenario, e)
+            return one_result(scenario, error=e)
+        finally:
+            with idle_lock:
+                idle.append(slot)
+        return one_result(scenario, *outcome)
+
+    started = time.time()
+    if args.mode == "async":
+        results = asyncio.run(run_all_async(credentials, args.scenarios,
+                                            args.trials, args.clients))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as pool:
+            results = list(pool.map(one, range(args.trials)))
+    summary = report(results, time.time() - started, args.clients)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0 if all(result["as_expected"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -23,8 +23,6 @@ import configparser
 import argparse
 
 import logging
-logging.basicConfig(format='%(levelname)s:%(message)s',
-                    level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
@@ -42,7 +40,7 @@ def command_line_args():
     parser.add_argument("--project", type=str,
                         help="Use configuration section")
     cli_args = parser.parse_args()
-    log.debug("<- Command line args: {}".format(cli_args))
+    log.debug("<- Command line args: %s", cli_args)
     return cli_args
 
 
@@ -54,7 +52,7 @@ def fake_cli_args():
     log.debug("-> Fake cli args")
     parser = argparse.ArgumentParser(description="CIS 322 Auto-Checker")
     cli_args = parser.parse_args([])
-    log.debug("<- Command line args: {}".format(cli_args))
+    log.debug("<- Command line args: %s", cli_args)
     return cli_args
 
 
@@ -68,10 +66,20 @@ def config_file_args(config_file_path, project=None):
     config.read(config_file_path)
     section = project or "DEFAULT"
     args = config[section]
-    log.debug("<- config file args: {}".format(args))
+    log.debug("<- config file args: %s", args)
     return args
 
 
+def configure_logging(settings):
+    """Log at the level named by LOG_LEVEL in settings (log_level in
+    config.ini), INFO if not given.  Programs call this once they
+    have read their configuration; importing modules does not.
+    """
+    level = str(settings.get("LOG_LEVEL", "INFO")).upper()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=level)
+    return level
+
+
 def imply_types(ns: dict):
     """Convert values to implied types.  We assume that strings of
     digits should be integers, and True/False (with any casing) should
@@ -105,19 +113,19 @@ def configuration(proxied=False):
     else:
         cli = command_line_args()
     cli_vars = vars(cli)  # Access the namespace as a dict
-    log.debug("CLI variables: {}".format(cli_vars))
+    log.debug("CLI variables: %s", cli_vars)
     config_file_path = cli_vars.get("config") or "config.ini"
-    log.debug("Will read configuration file from '{}'"
-              .format(config_file_path))
+    log.debug("Will read configuration file from '%s'",
+              config_file_path)
     config_for_project = cli_vars.get("project", None)
     ini = config_file_args(config_file_path, config_for_project)
-    log.debug("Config file args: {}".format(ini))
+    log.debug("Config file args: %s", ini)
     # Fold into cli namespace with precedence for command line arguments
     for var_lower in ini:
         var_upper = var_lower.upper()
-        log.debug("Variable '{}'".format(var_upper))
+        log.debug("Variable '%s'", var_upper)
         if var_upper in cli_vars and cli_vars[var_upper]:
-            log.debug("Overridden by cli val '{}'".format(cli_vars[var_upper]))
+            log.debug("Overridden by cli val '%s'", cli_vars[var_upper])
         else:
             log.debug("Storing in cli")
             cli_vars[var_upper] = ini[var_lower]
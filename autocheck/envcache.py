@@ -0,0 +1,251 @@
+"""
+Cache of virtual environments for 'make install'.
+
+Starting with project 2, every student's 'make install' builds a
+virtual environment and pip-installs much the same requirements from
+scratch, which is the slowest and hungriest stage of a trial.  We keep
+environments keyed by a hash of requirements.txt and the Python that
+built them, so any trial with the same requirements, whoever's it
+is, gets a copy instead of building its own.
+
+A cached environment is never a copy of one a student's install
+built, since a Makefile can put anything in env/ and the author
+named in the credentials is whatever the student wrote there.  After
+a successful install that missed the cache, populate() builds a fresh
+environment itself, with 'python3 -m venv' and 'pip install -r' of a
+copy of requirements.txt alone (so relative paths in it, e.g. '-e .',
+fail rather than reach into the student's clone), and makes it
+read-only.  An environment is thus a function of its key.  Student
+code runs as the same user as the checker, so read-only guards the
+cache against accidents, such as a trial writing into a copy that
+is not one, rather than against a student bent on changing it.
+
+Copies are made with 'cp --reflink=auto', which is copy-on-write on
+file systems that support it and a plain copy elsewhere, and made
+writable again.  Virtual environments record their own location in
+the scripts in env/bin, so those are rewritten for the new location
+("relocated").
+
+The cache is capped in size, evicting the least recently used
+environments, and counts hits and misses in stats.json.
+"""
+
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+
+import runner
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+VENV_CACHE_DIR = "/tmp/,venvs"
+VENV_CACHE_MB = 2000
+
+_python_version = None
+
+
+def key(clone_path):
+    """Cache key for the environment of clone_path's requirements,
+    or None if the project has no requirements.txt.
+    """
+    requirements = os.path.join(clone_path, "requirements.txt")
+    if not os.path.exists(requirements):
+        return None
+    digest = hashlib.sha256(python_version().encode("utf-8") + b"\0")
+    with open(requirements, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()[:24]
+
+
+def entry_path(clone_path, cache_dir=VENV_CACHE_DIR):
+    """Where the environment for clone_path's requirements is cached
+    (whether or not it is yet), or None if it has no requirements.txt.
+    """
+    env_key = key(clone_path)
+    return os.path.join(cache_dir, env_key) if env_key else None
+
+
+def python_version():
+    """Version of the python3 that 'make install' would run."""
+    global _python_version
+    if _python_version is None:
+        _python_version = subprocess.check_output(
+            ["python3", "-c", "import sys; print(sys.version)"],
+            universal_newlines=True).strip()
+    return _python_version
+
+
+def restore(clone_path, cache_dir=VENV_CACHE_DIR):
+    """If an environment for clone_path's requirements is cached, copy
+    it to clone_path/env and return True; otherwise False.
+    """
+    env_key = key(clone_path)
+    if env_key is None:
+        return False
+    entry = os.path.join(cache_dir, env_key)
+    if not os.path.isdir(os.path.join(entry, "env")):
+        _count("misses", cache_dir)
+        return False
+    with shared.locked(entry):
+        if not os.path.isdir(os.path.join(entry, "env")):
+            _count("misses", cache_dir)   # Evicted meanwhile
+            return False
+        with open(os.path.join(entry, "origin")) as f:
+            origin = f.read()
+        target = os.path.join(clone_path, "env")
+        _remove(target)
+        _copy(os.path.join(entry, "env"), target)
+        os.utime(entry)   # Most recently used
+    _set_writable(target, True)
+    relocate(target, origin)
+    _count("hits", cache_dir)
+    log.debug("Restored environment %s into %s", env_key, clone_path)
+    return True
+
+
+async def populate(clone_path, cache_dir=VENV_CACHE_DIR, limits=None):
+    """Build and keep an environment for clone_path's requirements,
+    unless the cache already has one.  A coroutine: the environment is
+    built by 'python3 -m venv' and pip, as asyncio subprocesses under
+    limits (see limits.py), if given.  Raises
+    subprocess.CalledProcessError or subprocess.TimeoutExpired if the
+    build fails, in which case nothing is kept.  The caller should
+    evict() afterward, keeping entry_path(clone_path).
+    """
+    entry = entry_path(clone_path, cache_dir)
+    if entry is None:
+        return
+    async with shared.locked_async(entry):
+        if os.path.isdir(os.path.join(entry, "env")):
+            return
+        os.makedirs(entry, exist_ok=True)
+        requirements = os.path.join(entry, "requirements.txt")
+        shutil.copyfile(os.path.join(clone_path, "requirements.txt"),
+                        requirements)
+        build = os.path.join(entry, "env.new")
+        _remove(build)
+        try:
+            await runner.run_async(["python3", "-m", "venv", build],
+                                   cwd=entry, limits=limits)
+            await runner.run_async(
+                [os.path.join(build, "bin", "pip"), "install",
+                 "--disable-pip-version-check", "-r", requirements],
+                cwd=entry, limits=limits)
+        except BaseException:
+            _remove(build)
+            raise
+        # Scripts point at env.new; restore() rewrites them
+        with open(os.path.join(entry, "origin"), "w") as f:
+            f.write(build)
+        _set_writable(build, False)
+        os.rename(build, os.path.join(entry, "env"))
+    log.debug("Cached environment %s for %s", entry, clone_path)
+
+
+def relocate(env_path, origin):
+    """Rewrite references to origin in the text files of env_path/bin."""
+    bin_path = os.path.join(env_path, "bin")
+    old = origin.encode("utf-8")
+    new = env_path.encode("utf-8")
+    for name in os.listdir(bin_path):
+        path = os.path.join(bin_path, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+        if b"\0" in content or old not in content:
+            continue   # Binary, or nothing to change
+        with open(path, "wb") as f:
+            f.write(content.replace(old, new))
+
+
+def evict(cache_dir=VENV_CACHE_DIR, cap_mb=VENV_CACHE_MB, keep=None):
+    """Remove least recently used environments until the cache is
+    within cap_mb megabytes.  Entries in use are skipped.  Lock files
+    of entries no longer cached are removed too.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and path != keep:
+            entries.append((os.stat(path).st_mtime, path))
+        elif name.endswith(".lock") and name != "stats.json.lock" \
+                and not os.path.exists(path[:-len(".lock")]):
+            _remove_lock(path[:-len(".lock")])
+    total = sum(shared.tree_size(path) for _, path in entries)
+    if keep:
+        total += shared.tree_size(keep)
+    cap = cap_mb * 1024 * 1024
+    for _, path in sorted(entries):
+        if total <= cap:
+            break
+        with shared.locked(path, blocking=False) as got_it:
+            if not got_it:
+                continue
+            size = shared.tree_size(path)
+            _remove(path)
+            os.remove(path + ".lock")
+            total -= size
+            _count("evictions", cache_dir)
+            log.info("Evicted environment %s (%s bytes)", path, size)
+
+
+def stats(cache_dir=VENV_CACHE_DIR):
+    """Dict of hits, misses, evictions, hit rate, and entry count."""
+    counts = shared.read_json(os.path.join(cache_dir, "stats.json"), {})
+    result = {"hits": counts.get("hits", 0),
+              "misses": counts.get("misses", 0),
+              "evictions": counts.get("evictions", 0)}
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else None
+    result["environments"] = len(
+        [name for name in os.listdir(cache_dir)
+         if os.path.isdir(os.path.join(cache_dir, name))]
+    ) if os.path.isdir(cache_dir) else 0
+    return result
+
+
+def _remove_lock(entry):
+    """Remove the lock file of entry, unless it is held."""
+    with shared.locked(entry, blocking=False) as got_it:
+        if got_it:
+            os.remove(entry + ".lock")
+
+
+def _set_writable(path, writable):
+    """Give the owner write permission on everything under path, or
+    take away everyone's.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in [dirpath] + [os.path.join(dirpath, name)
+                                 for name in filenames]:
+            if os.path.islink(name):
+                continue
+            mode = os.lstat(name).st_mode
+            if writable:
+                mode |= stat.S_IWUSR
+            else:
+                mode &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+            os.chmod(name, stat.S_IMODE(mode))
+
+
+def _remove(path):
+    """Remove path, read-only or not, if it exists."""
+    if os.path.isdir(path):
+        _set_writable(path, True)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _copy(source, target):
+    subprocess.check_output(["cp", "-a", "--reflink=auto", source, target],
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+
+
+def _count(counter, cache_dir):
+    with shared.updating(os.path.join(cache_dir, "stats.json"), {}) as counts:
+        counts[counter] = counts.get(counter, 0) + 1
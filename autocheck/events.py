@@ -0,0 +1,91 @@
+"""
+Trace events: a timeline of what happened in each trial.
+
+Each event is a small dict, e.g.,
+   {"time": 1700000000.25, "job": "3f2a9c0e1b7d", "event": "stage_end",
+    "stage": "install", "ok": true, "seconds": 41.2}
+appended as one line of JSON to TRACE_DIR/<job>.jsonl.  Concurrent
+trials write to separate files, and each line is written with a
+single append, so events never interleave mid-line.  timeline()
+reads one job's events back in order, for the timeline page.  Events
+of a trial run by a remote worker are merged into the trace on the
+web server when the worker reports its result.  Traces older than
+TRACE_KEEP_DAYS are removed by the reaper (see trial.reap_expired).
+
+Events are also logged at DEBUG level, formatted only if debug
+logging is on.
+"""
+
+import json
+import os
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+TRACE_DIR = "/tmp/,trace"
+TRACE_KEEP_DAYS = 14
+
+
+def emit(job, event, trace_dir=TRACE_DIR, **fields):
+    """Append an event of job's to its trace (if trace_dir is set)."""
+    record = dict(time=time.time(), job=job, event=event, **fields)
+    log.debug("%s %s %s", job, event, fields)
+    _append(job, [record], trace_dir)
+
+
+def merge(job, records, trace_dir=TRACE_DIR):
+    """Append events of job's recorded elsewhere (e.g., by a remote
+    worker, see worker.py), as they were, to its trace here; except
+    those already here, as when the worker shares this trace_dir.
+    """
+    known = {(event["time"], event["event"])
+             for event in timeline(job, trace_dir)}
+    _append(job, [record for record in records
+                  if (record["time"], record["event"]) not in known],
+            trace_dir)
+
+
+def _append(job, records, trace_dir):
+    if not trace_dir or not records:
+        return
+    text = "".join(json.dumps(record, default=str) + "\n"
+                   for record in records)
+    try:
+        os.makedirs(trace_dir, exist_ok=True)
+        fd = os.open(trace_path(job, trace_dir),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, text.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        log.warning("Could not record events of %s: %s", job, e)
+
+
+def timeline(job, trace_dir=TRACE_DIR):
+    """job's events, oldest first, each with "offset" (seconds since
+    the first event) added.  Empty if there are none.
+    """
+    if not trace_dir:
+        return []
+    events = []
+    try:
+        with open(trace_path(job, trace_dir)) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue   # Torn last line of a crashed writer
+    except OSError:
+        return []
+    if events:
+        start = events[0]["time"]
+        for event in events:
+            event["offset"] = event["time"] - start
+    return events
+
+
+def trace_path(job, trace_dir=TRACE_DIR):
+    """File holding job's events."""
+    return os.path.join(trace_dir, "{}.jsonl".format(job.replace("/", "_")))
@@ -4,7 +4,11 @@ including github URL
 
 """
 
+import asyncio
+import base64
+import hmac
 import os
+import threading
 import flask
 from flask import render_template
 from flask import request
@@ -14,12 +18,26 @@ from werkzeug.utils import secure_filename
 
 import json
 import logging
+import time
+import uuid
 import config       # Reads from config.ini and command line
 
-import arrow        # For timestamp in file name creation
+import arrow        # For dates in templates
 import subprocess   # Installation process
 
 import trial  # The part of auto-grading that does not depend on flask
+import jobs   # Queue of trials, so requests need not wait for them
+import admission   # Rate limits on uploads
+import scheduler   # Which queued trial runs next
+import preflight   # Checks of uploads before any work is done
+import metrics
+import mirrors    # Caches, for reporting hit rates
+import envcache
+import sandbox    # Student servers and clones still alive
+import workspace  # Per-upload directories
+import events     # Trace of each trial, for the timeline page
+import store      # Record of every job, for history and _kill
+import results    # For the commit a submission would try
 
 ###
 # Globals
@@ -28,11 +46,32 @@ app = flask.Flask(__name__)
 proxied = __name__ != "__main__"
 CONFIG = config.configuration(proxied=proxied)
 app.config.from_object(CONFIG)
-app.logger.debug("Configuration: {}".format(app.config))
+app.logger.setLevel(config.configure_logging(app.config))
+app.logger.debug("Configuration: %s", app.config)
 
 # config = configparser.ConfigParser()
-app.logger.debug("Uploads to '{}'".format(app.config["UPLOAD_FOLDER"]))
-MAX_CONTENT_LENGTH = 64 * 1024  # 64K is plenty for a config file
+app.logger.debug("Uploads to '%s'", app.config["UPLOAD_FOLDER"])
+# Flask refuses larger requests (413); its own default is no limit
+if app.config.get("MAX_CONTENT_LENGTH") is None:
+    app.config["MAX_CONTENT_LENGTH"] = preflight.MAX_UPLOAD_BYTES
+# Credential fields each project requires, from config.ini sections
+PROJECT_FIELDS = preflight.fields_by_project(
+    getattr(CONFIG, "config", None) or "config.ini")
+# Jobs submitted in a session, remembered so that it may shut them down
+OWNED_JOBS = 20
+# Each page streaming a trial's output holds a request thread until the
+# trial is done; beyond MAX_STREAMS of them, pages poll /_status instead,
+# leaving threads (see start.sh) for everything else
+MAX_STREAMS = 4
+_streams = threading.BoundedSemaphore(app.config.get("MAX_STREAMS",
+                                                     MAX_STREAMS))
+trial.configure(app.config)
+jobs.start(workers=app.config.get("TRIAL_WORKERS", 2),
+           lost_seconds=app.config.get("WORKER_LOST_SECONDS",
+                                       jobs.LOST_SECONDS),
+           caps=scheduler.caps_for(app.config))
+sandbox.start_reaper(every=app.config.get("REAP_EVERY", sandbox.REAP_EVERY),
+                     reap=trial.reap_expired)
 
 
 ###
@@ -56,67 +95,403 @@ def upload_project():
     truthy value to enable the next step, or a falsy value to indicate
     that the submit/build/run process has failed.  We pass along a
     dictionary in which we stash useful information along the way.
+
+    The trial itself is queued (see jobs.py) rather than run here;
+    we redirect to a page that follows the progress of the job.
     """
     app.logger.debug("Entering _upload")
-    credentials_path = tmp_path("cred.ini")
+    context = {"messages":  ""}
+    # Run again even if this commit was checked before
+    context["fresh"] = "fresh" in flask.request.form
+    if not check_file_upload(request):
+        flask.flash("Credentials upload failed")
+        return flask.render_template("failed.html")
+    # Pre-flight checks, in memory, before any resources are spent
+    try:
+        credentials = check_submission(context)
+    except preflight.Rejected as e:
+        app.logger.info("Rejected upload: %s", e)
+        metrics.record_refusal(
+            "preflight",
+            metrics_file=app.config.get("METRICS_FILE",
+                                        metrics.METRICS_FILE))
+        flask.flash(str(e))
+        return flask.render_template("failed.html"), 400
+    # Each upload gets a workspace of its own (see workspace.py),
+    # for the credentials file and later the clone
+    try:
+        job_workspace = trial.new_workspace()
+    except workspace.QuotaExceeded as e:
+        app.logger.warning("No room for a workspace: %s", e)
+        flask.flash("The checker is out of space for the moment")
+        flask.flash("Please try again in {} seconds"
+                    .format(admission.BUSY_RETRY))
+        return (flask.render_template("failed.html"), 503,
+                {"Retry-After": str(admission.BUSY_RETRY)})
+    credentials_path = os.path.join(job_workspace, "credentials.ini")
 
     # The remainder of the processing should be in trial.py.
     # We give trial the path to a credentials file and a
     # context into which it can place messages.
-    context = {"credentials": credentials_path,
-               "messages":  ""
-               }
-
-    proj_app = flask.request.form["project"]
-    app.logger.debug("Project+App is {}".format(proj_app))
-    proj, projname = proj_app.split(":")
-    app.logger.debug("Project: {}".format(proj))
-    app.logger.debug("App: {}".format(projname))
-
-    context["project"] = proj  # Example proj0, proj1, etc
-    context["app"] = projname  # Example hello, pageserver, etc
+    context["credentials"] = credentials_path
+    context["workspace"] = job_workspace
 
-
-    # The credentials upload step is within the flask
-    # context, and
-    ok = (check_file_upload(request)
-          and upload_credentials(context))
-    app.logger.debug("Uploaded credentials to {}".format(credentials_path))
+    ok = upload_credentials(context, credentials)
+    app.logger.debug("Uploaded credentials to %s", credentials_path)
     if not ok:
+        workspace.finish(job_workspace)
         flask.flash("Credentials upload failed")
         return flask.render_template("failed.html")
         # return flask.redirect(url_for("index"))
-    app.logger.debug("Preparing call-out to trial module")
-    ok = trial.trial(context)
-    app.logger.debug("Returned from trial module")
-    # For the display ... 
-    flask.g.messages = context["messages"]
-    flask.g.port = context["port"]
-    # For subsequent steps (after current state is lost)
-    flask.session["clone_path"] = context["clone_path"]
-    flask.session["project"] = context["project"]
-    if ok:
+    priority = scheduler.priority_for(app.config,
+                                      request.remote_addr or "unknown")
+    refusal = admit(context, priority)
+    if refusal:
+        workspace.finish(job_workspace)
+        return refusal
+    app.logger.debug("Queueing trial (%s)", priority)
+    # Single flight: a resubmission of what is already being tried
+    # follows that trial, rather than starting another
+    key = single_flight_key(context)
+    job_id = jobs.submit(context, key=key, priority=priority)
+    if context.get("job_id") != job_id:
+        workspace.finish(job_workspace)
+        admission.release(context["admission"],
+                          state_file=app.config.get(
+                              "ADMISSION_FILE", admission.ADMISSION_FILE))
+        flask.flash("This commit is already being checked;"
+                    " here is that trial")
+    app.logger.debug("Queued trial as job %s", job_id)
+    own_job(job_id)
+    return flask.redirect(flask.url_for("job_page", job_id=job_id))
+
+
+@app.route("/job/<job_id>")
+def job_page(job_id):
+    """Progress of a queued trial; the results once it has finished."""
+    summary = jobs.status(job_id)
+    if summary is None:
+        flask.abort(404)
+    if summary["status"] in ("queued", "running"):
+        flask.g.job = summary
+        return flask.render_template("queued.html")
+    record = finished_job(job_id)
+    # For the display ...
+    flask.g.job_id = job_id
+    flask.g.messages = record["messages"]
+    flask.g.port = record.get("port")
+    flask.g.host = record.get("host")
+    if record.get("log_truncated"):
+        flask.g.log_url = flask.url_for("job_log", job_id=job_id)
+    flask.g.timeline_url = flask.url_for("job_timeline", job_id=job_id)
+    # Default for _kill
+    flask.session["job_id"] = job_id
+    if record["ok"]:
         flask.g.status = "OK"
     else:
         flask.g.status = "Errors"
 
-
     return flask.render_template("test_output.html")
 
+
+@app.route("/history")
+def history():
+    """Recent trials, optionally only those of an author, repo,
+    and/or project; as JSON with ?format=json.  Only the instructor
+    sees everyone's; others see the trials submitted in their session.
+    """
+    args = flask.request.args
+    records = store.history(author=args.get("author"),
+                            repo=args.get("repo"),
+                            project=args.get("project"),
+                            ids=None if is_instructor()
+                            else flask.session.get("jobs", []),
+                            limit=args.get("limit", 100, type=int),
+                            path=app.config.get("JOB_DB", store.JOB_DB))
+    if args.get("format") == "json":
+        return flask.jsonify(jobs=records)
+    flask.g.jobs = records
+    flask.g.stage_names = [name for name, step, deps in trial.STAGES]
+    return flask.render_template("history.html")
+
+
+@app.route("/queue")
+def queue_page():
+    """Trials running and waiting, in the order they are expected to
+    start; as JSON with ?format=json.  Only the instructor sees whose
+    they are: others see the ID and author only of their own session's
+    trials, and of the rest just where they stand.
+    """
+    queued = jobs.queue()
+    if not is_instructor():
+        owned = flask.session.get("jobs", [])
+        queued = [job if job["id"] in owned
+                  else dict(job, id=None, author=None, worker=None)
+                  for job in queued]
+    if flask.request.args.get("format") == "json":
+        return flask.jsonify(jobs=queued, caps=jobs.caps())
+    flask.g.jobs = queued
+    flask.g.caps = jobs.caps()
+    flask.g.now = time.time()
+    return flask.render_template("queue.html")
+
+
+@app.route("/_status/<job_id>")
+def job_status(job_id):
+    """Status, queue position, and (when finished) messages, as JSON"""
+    summary = jobs.status(job_id)
+    if summary is None:
+        flask.abort(404)
+    return flask.jsonify(summary)
+
+
+@app.route("/job/<job_id>/log.gz")
+def job_log(job_id):
+    """The full (compressed) log of a finished trial"""
+    record = finished_job(job_id)
+    if record is None:
+        flask.abort(404)
+    log_path = record.get("log_path")
+    if not log_path or not os.path.exists(log_path):
+        flask.abort(404)
+
+    def chunks():
+        with open(log_path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                yield chunk
+
+    return flask.Response(
+        chunks(), mimetype="application/gzip",
+        headers={"Content-Disposition":
+                 "attachment; filename=trial-{}.log.gz".format(job_id)})
+
+
+@app.route("/job/<job_id>/timeline")
+def job_timeline(job_id):
+    """What happened in a trial, and when (see events.py); as JSON
+    with ?format=json.
+    """
+    timeline = events.timeline(
+        job_id, trace_dir=app.config.get("TRACE_DIR", events.TRACE_DIR))
+    if not timeline:
+        flask.abort(404)
+    if flask.request.args.get("format") == "json":
+        return flask.jsonify(events=timeline)
+    for event in timeline:
+        event["details"] = ", ".join(
+            "{}={}".format(name, round(value, 3)
+                           if isinstance(value, float) else value)
+            for name, value in event.items()
+            if name not in ("time", "job", "event", "stage", "offset"))
+    flask.g.job_id = job_id
+    flask.g.events = timeline
+    return flask.render_template("timeline.html")
+
+
+@app.route("/_stream/<job_id>")
+def job_stream(job_id):
+    """Output of a trial as server-sent events, line by line as it is
+    produced.  A final "done" event tells the page to fetch results.
+    A trial that finished before this process forgot it gets just the
+    "done" event.  503 tells the page to poll /_status instead: when
+    MAX_STREAMS pages are streaming already, or the trial is one this
+    process does not have (e.g., it was accepted by another).
+    """
+    done = "event: done\ndata: {}\n\n".format(job_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if jobs.get(job_id) is None:
+        summary = jobs.status(job_id)
+        if summary is None:
+            flask.abort(404)
+        if summary["status"] not in ("done", "error"):
+            flask.abort(503)
+        return flask.Response(done, mimetype="text/event-stream",
+                              headers=headers)
+    if not _streams.acquire(blocking=False):
+        flask.abort(503)
+
+    def events():
+        for text in jobs.follow(job_id):
+            if text is None:
+                yield ": keepalive\n\n"
+                continue
+            yield "".join("data: {}\n".format(line)
+                          for line in text.split("\n")) + "\n"
+        yield done
+
+    response = flask.Response(events(), mimetype="text/event-stream",
+                              headers=headers)
+    # Also when the page goes away before the trial is done
+    response.call_on_close(_streams.release)
+    return response
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Trial and stage timings for Prometheus to scrape"""
+    text = metrics.render(app.config.get("METRICS_FILE",
+                                         metrics.METRICS_FILE))
+    text += metrics.render_caches({
+        "mirror": mirrors.stats(app.config.get("MIRROR_DIR",
+                                               mirrors.MIRROR_DIR)),
+        "venv": envcache.stats(app.config.get("VENV_CACHE_DIR",
+                                              envcache.VENV_CACHE_DIR))})
+    return flask.Response(text,
+                          mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/sandboxes")
+def sandboxes():
+    """Live trial sandboxes and the resources their processes use;
+    for the instructor only, as they name students' repositories.
+    """
+    if not is_instructor():
+        flask.abort(403)
+    return flask.jsonify(sandboxes=sandbox.live(
+        app.config.get("SANDBOX_REGISTRY", sandbox.REGISTRY)))
+
+
 @app.route("/_kill")
 def _kill():
-    # Here: Kill the job
-    context = { "project": flask.session["project"],
-                "clone_path": flask.session["clone_path"], 
+    # Here: Kill the job, as given (?job=ID) or last viewed, if it
+    # was submitted in this session (or we are the instructor)
+    job_id = flask.request.args.get("job") or flask.session.get("job_id")
+    if job_id and not (job_id in flask.session.get("jobs", [])
+                       or is_instructor()):
+        flask.abort(403)
+    record = finished_job(job_id) if job_id else None
+    if record is None or not record.get("clone_path"):
+        flask.flash("No trial to shut down")
+        return flask.redirect(flask.url_for("index"))
+    if record.get("worker"):
+        # Left running on a remote worker, which shuts it down
+        jobs.request_shutdown(record["worker"], job_id)
+        flask.flash("Asked worker {} to shut down the trial"
+                    .format(record["worker"]))
+        return flask.redirect(flask.url_for("index"))
+    context = { "project": record["project"],
+                "clone_path": record["clone_path"],
+                "job_id": job_id,
                 "messages": "Attempting shut down"
               }
-    
-    trial.shutdown(context)
+
+    asyncio.run(trial.timed_step("shutdown", trial.shutdown_async, context))
+    metrics.record_stage("shutdown", context["stages"]["shutdown"],
+                         metrics_file=app.config.get("METRICS_FILE",
+                                                     metrics.METRICS_FILE))
     flask.flash("Should kill off process using PID in {}"
                       .format(context["clone_path"]))
     flask.flash(context["messages"])
     return flask.redirect(flask.url_for("index"))
 
+
+###
+# Remote workers (see worker.py and jobs.py)
+###
+
+WORKER_MAX_BYTES = 64 * 1024 * 1024   # Results carry the compressed log
+# Claims waiting for a job each hold a request thread; beyond
+# MAX_CLAIMS of them, a claim gets a job only if one is ready now
+MAX_CLAIMS = 2
+_claims = threading.BoundedSemaphore(app.config.get("MAX_CLAIMS",
+                                                    MAX_CLAIMS))
+
+
+@app.route("/_worker/claim", methods=["POST"])
+def worker_claim():
+    """A worker asks for a job to run, waiting up to jobs.CLAIM_WAIT
+    seconds (unless MAX_CLAIMS others are waiting already); the reply
+    also lists trials it should shut down.  503 with Retry-After tells
+    the worker there is nothing for it, and to ask again later; a wait
+    that is not a number of seconds, 400.
+    """
+    body = worker_request()
+    worker = body.get("worker") or flask.abort(400)
+    try:
+        wait = float(body.get("wait", jobs.CLAIM_WAIT))
+    except (TypeError, ValueError):
+        flask.abort(400)
+    if not 0 <= wait:  # Also rejects NaN
+        flask.abort(400)
+    wait = min(wait, jobs.CLAIM_WAIT)
+    waiting = _claims.acquire(blocking=False)
+    try:
+        job = jobs.claim(worker, wait=wait if waiting else 0)
+    finally:
+        if waiting:
+            _claims.release()
+    shutdown = []
+    for job_id in jobs.shutdowns_for(worker):
+        record = finished_job(job_id)
+        if record and record.get("clone_path"):
+            shutdown.append({"job_id": job_id,
+                             "project": record["project"],
+                             "clone_path": record["clone_path"]})
+    if job is None and not shutdown and not waiting:
+        return flask.Response(status=503,
+                              headers={"Retry-After": str(int(wait))})
+    if job is None:
+        return flask.jsonify({"job": None, "shutdown": shutdown})
+    context = job["context"]
+    try:
+        with open(context["credentials"]) as f:
+            credentials = f.read()
+    except OSError as e:
+        app.logger.error("Credentials of job %s lost: %s", job["id"], e)
+        trial.note(context, "\n*** Checker failed: {} ***\n".format(e))
+        jobs.complete(job["id"], worker, False, "error", {})
+        return flask.jsonify({"job": None, "shutdown": shutdown})
+    return flask.jsonify({"job": {"id": job["id"],
+                                  "project": context["project"],
+                                  "app": context["app"],
+                                  "fresh": context.get("fresh", False),
+                                  "head": context.get("head"),
+                                  "credentials": credentials},
+                          "shutdown": shutdown})
+
+
+@app.route("/_worker/<job_id>/heartbeat", methods=["POST"])
+def worker_heartbeat(job_id):
+    """A worker is still running job_id; passes on its new output.
+    409 if the job is no longer the worker's.
+    """
+    body = worker_request()
+    if not jobs.heartbeat(job_id, body.get("worker"),
+                          body.get("output", "")):
+        return flask.jsonify({"ok": False}), 409
+    return flask.jsonify({"ok": True})
+
+
+@app.route("/_worker/<job_id>/result", methods=["POST"])
+def worker_result(job_id):
+    """A worker has finished job_id: its result, context, full log
+    (gzip, base64), and trace events.  409 if the job is no longer
+    the worker's.
+    """
+    body = worker_request(max_bytes=WORKER_MAX_BYTES)
+    worker = body.get("worker")
+    if not jobs.heartbeat(job_id, worker):
+        return flask.jsonify({"ok": False}), 409
+    reported = body.get("context", {})
+    updates = {name: reported[name]
+               for name in jobs.RESULT_FIELDS if name in reported}
+    updates["log_path"] = None
+    if body.get("log"):
+        log_dir = app.config.get("LOG_DIR", trial.LOG_DIR)
+        os.makedirs(log_dir, exist_ok=True)
+        updates["log_path"] = os.path.join(log_dir,
+                                           "{}.log.gz".format(job_id))
+        with open(updates["log_path"], "wb") as f:
+            f.write(base64.b64decode(body["log"]))
+    final = "done" if body.get("status") == "done" else "error"
+    if not jobs.complete(job_id, worker, bool(body.get("ok")), final,
+                         updates):
+        return flask.jsonify({"ok": False}), 409
+    events.merge(job_id, body.get("events", []),
+                 trace_dir=app.config.get("TRACE_DIR", events.TRACE_DIR))
+    return flask.jsonify({"ok": True})
+
+
 ##################
 #
 # Functions used by routes
@@ -124,6 +499,140 @@ def _kill():
 ##################
 
 
+def finished_job(job_id):
+    """The context of a finished job (with "ok"), from memory if this
+    process ran it, else from the job store; None if there is no such
+    finished job.
+    """
+    job = jobs.get(job_id)
+    if job is not None and job["finished"] is not None:
+        return dict(job["context"], ok=job["ok"])
+    record = store.get(job_id, path=app.config.get("JOB_DB", store.JOB_DB))
+    if record is None or record["finished"] is None:
+        return None
+    return record
+
+
+def worker_request(max_bytes=None):
+    """The JSON body of a request from a worker; aborts with 403
+    unless it carries the worker token (worker_token in config.ini,
+    without which no worker is accepted).
+    """
+    token = str(app.config.get("WORKER_TOKEN") or "").encode("utf-8")
+    given = request.headers.get("X-Worker-Token", "").encode("utf-8")
+    if not token or not hmac.compare_digest(given, token):
+        flask.abort(403)
+    if max_bytes:
+        request.max_content_length = max_bytes
+    return request.get_json(force=True, silent=True) or {}
+
+
+def check_submission(context):
+    """Pre-flight checks (see preflight.py) of the project chosen and
+    the credentials uploaded, which are noted in context.  Returns
+    the uploaded file's contents; raises preflight.Rejected if the
+    submission cannot succeed.
+    """
+    proj_app = flask.request.form.get("project", "")
+    app.logger.debug("Project+App is %s", proj_app)
+    proj, _, projname = proj_app.partition(":")
+    this_dir = os.path.dirname(__file__)
+    if not (proj and projname
+            and os.path.isdir(os.path.join(this_dir, "..", "tests", proj))):
+        raise preflight.Rejected("No such project: {}".format(proj_app))
+    context["project"] = proj  # Example proj0, proj1, etc
+    context["app"] = projname  # Example hello, pageserver, etc
+
+    data = request.files["cfgfile"].read()
+    student = preflight.check_credentials(
+        data, preflight.fields_for(proj, PROJECT_FIELDS),
+        max_bytes=app.config["MAX_CONTENT_LENGTH"])
+    context["author"] = student.get("author", "not specified")
+    context["repo_remote"] = student.get("repo", "not specified")
+    if "repo" in student:
+        context["head"] = preflight.check_reachable(
+            student["repo"],
+            cache_file=app.config.get("REACHABLE_FILE",
+                                      preflight.REACHABLE_FILE),
+            timeout=app.config.get("LS_REMOTE_TIMEOUT",
+                                   preflight.LS_REMOTE_TIMEOUT))
+    return data
+
+
+def single_flight_key(context):
+    """What a submission would try: repository, commit now at its
+    head, project, application, credentials uploaded, and whether a
+    fresh trial was asked for; None if the commit cannot be found.
+    The commit is noted in context["head"], for the trial (see
+    trial.cached_result); it is found again only if the pre-flight
+    check did not just find it.
+    """
+    if not context.get("head"):
+        context["head"] = results.remote_head(
+            context["repo_remote"],
+            timeout=app.config.get("LS_REMOTE_TIMEOUT",
+                                   preflight.LS_REMOTE_TIMEOUT))
+    commit = context["head"]
+    if commit is None:
+        return None
+    return (context["repo_remote"], commit, context["project"],
+            context["app"], results.credentials_version(
+                context["credentials"]),
+            bool(context.get("fresh")))
+
+
+def own_job(job_id):
+    """Note that job_id was submitted in this session, which may then
+    shut it down; only the last OWNED_JOBS are remembered.
+    """
+    owned = [other for other in flask.session.get("jobs", [])
+             if other != job_id]
+    flask.session["jobs"] = (owned + [job_id])[-OWNED_JOBS:]
+
+
+def is_instructor():
+    """Whether the request comes from an instructor address (see
+    scheduler.priority_for).
+    """
+    priority = scheduler.priority_for(app.config,
+                                      request.remote_addr or "unknown")
+    return priority == "instructor"
+
+
+def admit(context, priority):
+    """Admission control (see admission.py): None if the trial may be
+    queued, else a 429 response saying when to try again.  The
+    instructor's submissions are not rate limited.
+    """
+    buckets = admission.buckets_for(app.config, context["author"],
+                                    context["repo_remote"],
+                                    request.remote_addr or "unknown")
+    if priority == "instructor":
+        buckets = []
+    context["admission"] = uuid.uuid4().hex   # Held until the job ends
+    refusal = admission.admit(
+        context["admission"], buckets,
+        max_in_flight=app.config.get("MAX_IN_FLIGHT",
+                                     admission.MAX_IN_FLIGHT),
+        state_file=app.config.get("ADMISSION_FILE",
+                                  admission.ADMISSION_FILE))
+    if refusal is None:
+        return None
+    seconds, reason = refusal
+    app.logger.info("Refused upload (%s); retry in %s seconds",
+                    reason, seconds)
+    metrics.record_refusal(
+        reason,
+        metrics_file=app.config.get("METRICS_FILE", metrics.METRICS_FILE))
+    if reason == "in_flight":
+        flask.flash("The checker is busy with other trials")
+    else:
+        flask.flash("Too many submissions from this {}".format(reason))
+    flask.flash("Please try again in {} seconds".format(seconds))
+    return (flask.render_template("failed.html"), 429,
+            {"Retry-After": str(seconds)})
+
+
 def check_file_upload(request):
     """Attempt to upload a credentials file.
     If successful, returns True and leaves file
@@ -145,12 +654,12 @@ def check_file_upload(request):
     return True
 
 
-def upload_credentials(project_context):
-    """Attempt to upload the credentials file"""
-    file = request.files['cfgfile']
+def upload_credentials(project_context, data):
+    """Attempt to save the uploaded credentials file (data)"""
     credentials_path = project_context["credentials"]
     try:
-        file.save(credentials_path)
+        with open(credentials_path, "wb") as f:
+            f.write(data)
         flash('file uploaded to {}'.format(credentials_path))
         return True
     except Exception as e:
@@ -165,16 +674,6 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() == "ini"
 
 
-def tmp_path(name, dir=app.config["UPLOAD_FOLDER"]):
-    """Return a unique local path in /tmp based on name."""
-    # While Python's UUID module could do this,
-    # we don't need universal uniqueness, so a shorter
-    # name based on timestamp will do.  Leading comma
-    # encourages daily cleanup.
-    ts = arrow.now().timestamp
-    return "{}/,{}.{}".format(dir, name[0:8], ts)
-
-
 ##################
 #
 # Error handling
@@ -196,6 +695,14 @@ def page_not_found(error):
     return flask.render_template('403.html'), 403
 
 
+@app.errorhandler(413)
+def upload_too_large(error):
+    app.logger.debug("413: Upload too large")
+    flask.flash("Upload is larger than the limit of {} bytes"
+                .format(app.config["MAX_CONTENT_LENGTH"]))
+    return flask.render_template('failed.html'), 413
+
+
 @app.errorhandler(500)
 def page_not_found(error):
     app.logger.debug("500: Internal error")
@@ -218,6 +725,14 @@ def format_arrow_date(date):
         return "(bad date {})".format(date)
 
 
+@app.template_filter('fmttime')
+def format_timestamp(timestamp):
+    """Local date and time of a time.time() timestamp."""
+    if timestamp is None:
+        return ""
+    return arrow.get(timestamp).to("local").format("MM/DD HH:mm:ss")
+
+
 #############
 #
 # Set up to run in gunicorn or
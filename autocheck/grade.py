@@ -0,0 +1,152 @@
+"""
+Batch grading: run trials for a whole class of credentials files.
+
+Usage (from the autocheck directory):
+   python3 grade.py --project proj1:pageserver  path/to/credentials_dir
+Options:
+   -C config.ini     grader configuration (as for flask_grader)
+   -j N              run N trials at once (default 4)
+   -o summary.csv    where to write the summary; a name ending in
+                     .json gives JSON instead of CSV.  Default stdout.
+   --keep-running    leave student servers up for manual testing
+                     (otherwise each trial is shut down when done)
+   --cached          report the earlier result for a commit already
+                     checked (e.g., by the student), rather than
+                     running every trial afresh
+
+Every *.ini file in the directory is taken to be one student's
+credentials.  The summary has one row per file with the author and
+repository, whether each stage passed, how long each stage took,
+and where the full log of the trial is kept.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import config
+import trial
+
+import logging
+log = logging.getLogger(__name__)
+
+STAGE_NAMES = [name for name, step, deps in trial.STAGES]
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(
+        description="CIS 322 Auto-Checker: grade a batch of projects")
+    parser.add_argument("credentials_dir",
+                        help="Directory of student credentials (.ini) files")
+    parser.add_argument("--project", required=True,
+                        help="Project and application, e.g., proj1:pageserver")
+    parser.add_argument("-C", "--config", default="config.ini",
+                        help="Grader configuration file")
+    parser.add_argument("-j", "--workers", type=int, default=4,
+                        help="Number of trials to run at once")
+    parser.add_argument("-o", "--out", default=None,
+                        help="Summary file (.csv or .json); default stdout")
+    parser.add_argument("--keep-running", action="store_true",
+                        help="Do not shut down student servers")
+    parser.add_argument("--cached", action="store_true",
+                        help="Reuse results of earlier trials of a commit")
+    return parser.parse_args()
+
+
+def settings_from(config_path):
+    """Grader settings from the configuration file, upper-cased
+    and typed as config.py does for the Flask application.
+    """
+    ini = config.config_file_args(config_path)
+    settings = {var.upper(): ini[var] for var in ini}
+    config.imply_types(settings)
+    return settings
+
+
+def grade_one(credentials, project, keep_running=False, fresh=True):
+    """Run one trial; returns a summary row (a dict)."""
+    proj, app = project.split(":")
+    context = {"credentials": credentials,
+               "messages": "",
+               "project": proj,
+               "app": app,
+               "fresh": fresh
+               }
+    student = trial.read_config(credentials)
+    row = {"credentials": os.path.basename(credentials),
+           "author": student["author"],
+           "repo": student["repo"]}
+    started = time.time()
+    try:
+        row["ok"] = bool(trial.trial(context))
+    except Exception as e:
+        log.error("Trial of %s raised %s", credentials, e)
+        row["ok"] = False
+        row["error"] = str(e)
+    if not keep_running:
+        if context.get("port"):
+            trial.shutdown(context)
+        elif "clone_path" in context:
+            trial.release(trial.lease_holder(context))   # Just the clone
+    row["seconds"] = round(time.time() - started, 2)
+    stages = context.get("stages", {})
+    for name in STAGE_NAMES:
+        outcome = stages.get(name, {"ok": None, "seconds": 0.0})
+        row[name] = outcome["ok"]
+        row[name + "_seconds"] = round(outcome["seconds"], 2)
+    row["commit"] = context.get("commit")
+    row["cached"] = context.get("cached", False)
+    row["log"] = context.get("log_path")
+    return row
+
+
+def _grade_one(job):
+    """Pool entry point (arguments packed in one tuple)."""
+    return grade_one(*job)
+
+
+def write_summary(rows, out):
+    """Write rows to out (a path, or None for stdout)."""
+    stream = open(out, "w", newline="") if out else sys.stdout
+    try:
+        if out and out.endswith(".json"):
+            json.dump(rows, stream, indent=2)
+            stream.write("\n")
+            return
+        columns = (["credentials", "author", "repo", "ok", "seconds"]
+                   + [column for name in STAGE_NAMES
+                      for column in (name, name + "_seconds")]
+                   + ["commit", "cached", "log", "error"])
+        writer = csv.DictWriter(stream, columns, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out:
+            stream.close()
+
+
+def main():
+    args = command_line_args()
+    settings = settings_from(args.config)
+    config.configure_logging(settings)
+    credentials = sorted(glob.glob(os.path.join(args.credentials_dir,
+                                                "*.ini")))
+    log.info("Grading %s submissions, %s at a time",
+             len(credentials), args.workers)
+    jobs = [(path, args.project, args.keep_running, not args.cached)
+            for path in credentials]
+    with multiprocessing.Pool(args.workers, initializer=trial.configure,
+                              initargs=(settings,)) as pool:
+        rows = pool.map(_grade_one, jobs, chunksize=1)
+    write_summary(rows, args.out)
+    passed = sum(1 for row in rows if row["ok"])
+    log.info("%s of %s passed", passed, len(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+"""
+Queue of trial jobs, drained by a small pool of worker threads.
+
+A trial (clone, install, style check, test) can take the better part
+of a minute.  Running it inside the request would pin a gunicorn
+worker for that whole time, so instead the upload handler submits
+the trial context here and gets back a job ID immediately.  The
+browser then polls for the status of that job.
+
+Jobs do not simply run in the order they were submitted: whenever a
+worker is free, scheduler.py picks the queued job to run next, by
+priority class (instructor, local, remote), with a cap on the jobs of
+each class running at once, and fairly among students within a class.
+queue() shows the jobs running and waiting, in that order.
+
+Each job is a dict:
+   "id"        job ID (also stored in the context as "job_id")
+   "context"   the trial context, as described in trial.py
+   "status"    "queued", "running", "done", or "error"
+   "ok"        result of trial.trial once done
+   "priority"  priority class, and "author" the student it is for;
+               these decide which queued job runs next (see
+               scheduler.py)
+   "submitted", "started", "finished"   timestamps (time.time())
+   "output"    the most recent messages, as a deque of chunks of
+               text, which follow() streams while the trial runs;
+               "dropped" counts older chunks let go to stay within
+               LIVE_OUTPUT characters
+
+Trials may also run on other machines: remote workers (see worker.py)
+claim() queued jobs from the coordinator (the web server) over HTTP,
+send heartbeat()s with the output so far while they run them, and
+complete() them with the results.  A job whose worker has sent no
+heartbeat for LOST_SECONDS is queued again (at the front), up to
+MAX_ATTEMPTS times in all; the worker, if it is still alive, learns
+at its next heartbeat that the job is no longer its own.  Shutting
+down a trial left running on a worker is passed on to that worker
+with its next claim().  Remote jobs also have:
+   "worker"    name of the worker running it
+   "heartbeat" time of the last heartbeat
+   "attempts"  number of times it has been started
+
+A job may be submitted with a key saying what it will try (e.g., the
+repository, project, and commit).  While a job with that key is queued
+or running, submitting the same key again starts nothing: the caller
+gets the ID of the job already in flight, and so its output and result
+(single flight).
+
+Jobs live in memory in the process that accepted them.  Finished
+jobs are kept for a while so that results can still be viewed, and
+then forgotten (oldest first) when there are more than RETAIN of them.
+Each job is also recorded in the job store (see store.py), which
+outlives both, so status() can still report on a forgotten job.
+"""
+
+import collections
+import itertools
+import sqlite3
+import threading
+import time
+import uuid
+
+import admission
+import metrics
+import scheduler
+import store
+import trial
+
+import logging
+log = logging.getLogger(__name__)
+
+RETAIN = 200   # Finished jobs to remember
+LIVE_OUTPUT = 64 * 1024   # Characters of output kept for streaming
+CLAIM_WAIT = 5   # Seconds a worker's claim waits for a job
+LOST_SECONDS = 30   # Without a heartbeat, a remote worker is lost
+MAX_ATTEMPTS = 3
+# Context fields a remote worker reports with the result of a trial
+RESULT_FIELDS = ["messages", "stages", "port", "server_pid", "commit",
+                 "cached", "clone_path", "log_truncated", "output_bytes",
+                 "author", "repo_remote", "host"]
+
+_lock = threading.Condition()
+_queue = collections.deque()   # IDs of waiting jobs, longest waiting first
+_caps = dict(scheduler.MAX_RUNNING)   # Running jobs allowed per class
+_served = collections.OrderedDict()   # (Class, author): last job started
+_starts = itertools.count(1)
+_jobs = collections.OrderedDict()   # All known jobs, oldest first
+_workers = []
+_output = threading.Condition()   # Notified when any job has new output
+_shutdowns = collections.defaultdict(list)   # Worker: jobs to shut down
+_lost = {}   # Worker: when it was last found lost
+_in_flight = {}   # Key: ID of the queued or running job with that key
+_monitor = []
+
+
+def start(workers=2, lost_seconds=LOST_SECONDS, caps=None):
+    """Start the pool of trial workers (once per process), and the
+    thread that queues again the jobs of lost remote workers.  caps,
+    if given, are the jobs of each priority class that may run at
+    once, local and remote workers together (see scheduler.caps_for).
+    """
+    with _lock:
+        if caps is not None:
+            _caps.update(caps)
+        while len(_workers) < workers:
+            worker = threading.Thread(target=_work,
+                                      name="trial-{}".format(len(_workers)),
+                                      daemon=True)
+            _workers.append(worker)
+            worker.start()
+        if not _monitor:
+            _monitor.append(threading.Thread(target=_watch_workers,
+                                             args=(lost_seconds,),
+                                             name="job-monitor",
+                                             daemon=True))
+            _monitor[0].start()
+    log.debug("Trial worker pool has %s threads", len(_workers))
+
+
+def submit(context, key=None, priority="remote"):
+    """Queue a trial of context, in priority class priority (see
+    scheduler.py); returns the new job ID.  If a job
+    with the same key (if given) is queued or running, nothing is
+    queued and that job's ID is returned instead; context["job_id"]
+    is set only for a new job.
+    """
+    if key is not None:
+        job_id = attach(key)
+        if job_id is not None:
+            return job_id
+    job_id = uuid.uuid4().hex[:12]
+    job = {"id": job_id,
+           "context": context,
+           "status": "queued",
+           "ok": None,
+           "submitted": time.time(),
+           "started": None,
+           "finished": None,
+           "output": collections.deque(),
+           "output_size": 0,
+           "dropped": 0,
+           "worker": None,
+           "heartbeat": None,
+           "attempts": 0,
+           "key": key,
+           "priority": priority,
+           "author": context.get("author")
+           }
+    with _lock:
+        other = _jobs.get(_in_flight.get(key))
+        if other is None:
+            if key is not None:
+                _in_flight[key] = job_id
+            context["job_id"] = job_id
+            context["listener"] = lambda text: _emit(job, text)
+            _jobs[job_id] = job   # Known, but not yet in the queue
+    if other is not None:
+        return _attached(other)   # Submitted meanwhile
+    # Recorded before any worker can start it, but not holding the
+    # lock, which a slow store would then hold up
+    trial.trace(context, "queued", priority=priority)
+    _record(store.submitted, job_id, context, job["submitted"])
+    with _lock:
+        _queue.append(job_id)
+        _lock.notify_all()
+    log.debug("Queued job %s", job_id)
+    return job_id
+
+
+def attach(key):
+    """The ID of the queued or running job with key, or None."""
+    with _lock:
+        job = _jobs.get(_in_flight.get(key))
+    if job is None:
+        return None
+    return _attached(job)
+
+
+def _attached(job):
+    """Note another submission of job, and return its ID."""
+    log.info("Submission attached to job %s", job["id"])
+    trial.trace(job["context"], "attached")
+    return job["id"]
+
+
+def claim(worker, wait=CLAIM_WAIT):
+    """Take the next queued job for the remote worker named worker,
+    waiting up to wait seconds for one.  Returns the job, or None.
+    """
+    since = time.time()
+    deadline = since + wait
+    with _lock:
+        while True:
+            if _lost.get(worker, 0) >= since:
+                return None   # Claim made before the worker was lost
+            job = _next()
+            if job is not None:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            _lock.wait(remaining)
+        _take(job, worker)
+    _begin(job)
+    return job
+
+
+def heartbeat(job_id, worker, output=""):
+    """The remote worker is still running job_id, and has produced
+    output since its last heartbeat.  Returns False if the job is no
+    longer the worker's (it was given up as lost, or is unknown).
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job["status"] != "running" \
+                or job["worker"] != worker:
+            return False
+        job["heartbeat"] = time.time()
+    if output:
+        _emit(job, output)
+    return True
+
+
+def complete(job_id, worker, ok, final, updates):
+    """The remote worker has finished job_id, with result ok and
+    status final ("done" or "error"); updates (a dict) are added to
+    the job's context.  Returns False if the job is no longer the
+    worker's, in which case the result is ignored.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job["status"] != "running" \
+                or job["worker"] != worker:
+            return False
+        job["context"].update(updates)
+    _end(job, ok, final)
+    return True
+
+
+def request_shutdown(worker, job_id):
+    """Ask the remote worker to shut down the trial of job_id."""
+    with _lock:
+        _shutdowns[worker].append(job_id)
+
+
+def shutdowns_for(worker):
+    """Jobs the remote worker has been asked to shut down (once)."""
+    with _lock:
+        return _shutdowns.pop(worker, [])
+
+
+def get(job_id):
+    """The job dict for job_id, or None if unknown (or forgotten)."""
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def position(job_id):
+    """How many jobs are expected to start before this one
+    (0 means it is next), or None if it is not waiting.
+    """
+    with _lock:
+        order = [job["id"] for job in _order()]
+    try:
+        return order.index(job_id)
+    except ValueError:
+        return None
+
+
+def queue():
+    """The jobs running, then those waiting in the order they are
+    expected to start, as summaries suitable for returning as JSON.
+    """
+    with _lock:
+        running = _running()
+        waiting = _order()
+        positions = {job["id"]: n for n, job in enumerate(waiting)}
+        return [{"id": job["id"],
+                 "status": job["status"],
+                 "priority": job["priority"],
+                 "author": job["author"],
+                 "project": job["context"].get("project"),
+                 "submitted": job["submitted"],
+                 "started": job["started"],
+                 "worker": job["worker"],
+                 "position": positions.get(job["id"])}
+                for job in running + waiting]
+
+
+def caps():
+    """Jobs of each priority class that may run at once."""
+    with _lock:
+        return dict(_caps)
+
+
+def status(job_id):
+    """Summary of a job suitable for returning as JSON,
+    or None if the job is unknown.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return _summary(job)
+    return _stored_status(job_id)
+
+
+def _summary(job):
+    """status() of a job in memory.  Call with _lock held."""
+    job_id = job["id"]
+    summary = {"id": job_id,
+               "status": job["status"],
+               "ok": job["ok"],
+               "submitted": job["submitted"],
+               "started": job["started"],
+               "finished": job["finished"],
+               "position": None,
+               "messages": None,
+               "worker": job["worker"],
+               "priority": job["priority"]
+               }
+    if job["status"] == "queued":
+        order = [job["id"] for job in _order()]
+        if job_id in order:
+            summary["position"] = order.index(job_id)
+    if job["status"] in ("done", "error"):
+        summary["messages"] = job["context"]["messages"]
+        summary["port"] = job["context"].get("port")
+        summary["stages"] = job["context"].get("stages", {})
+    return summary
+
+
+def follow(job_id, keepalive=15):
+    """Generate the output of a job as it is produced, from the
+    beginning, ending when the job has finished.  Yields None after
+    keepalive seconds without output, so that the caller can keep
+    its connection from going idle.
+    """
+    job = get(job_id)
+    if job is None:
+        return
+    sent = 0   # Counting chunks from the very first, dropped or not
+    while True:
+        with _output:
+            if (sent == job["dropped"] + len(job["output"])
+                    and job["finished"] is None):
+                _output.wait(keepalive)
+            skipped = max(0, job["dropped"] - sent)
+            chunks = list(job["output"])[sent + skipped - job["dropped"]:]
+            finished = job["finished"] is not None
+        sent += skipped + len(chunks)
+        if skipped:
+            yield "\n[... earlier output skipped ...]\n"
+        if chunks:
+            yield "".join(chunks)
+        elif finished:
+            return
+        else:
+            yield None
+
+
+def _emit(job, text):
+    """Listener for the trial context: record and announce output."""
+    with _output:
+        job["output"].append(text)
+        job["output_size"] += len(text)
+        while job["output_size"] > LIVE_OUTPUT and len(job["output"]) > 1:
+            job["output_size"] -= len(job["output"].popleft())
+            job["dropped"] += 1
+        _output.notify_all()
+
+
+def _work():
+    """Worker thread: run queued trials forever."""
+    while True:
+        with _lock:
+            job = _next()
+            while job is None:
+                _lock.wait()
+                job = _next()
+            _take(job, None)
+        _begin(job)
+        context = job["context"]
+        try:
+            ok = trial.trial(context)
+            final = "done"
+        except Exception as e:
+            log.error("Job %s raised %s", job["id"], e)
+            trial.trace(context, "job_error", error=str(e))
+            trial.note(context, "\n*** Checker failed: {} ***\n"
+                       .format(e))
+            ok = False
+            final = "error"
+        _end(job, ok, final)
+
+
+def _next():
+    """The queued job to run next (see scheduler.py), or None if there
+    is none or the classes with jobs queued are at their caps.  Call
+    with _lock held.
+    """
+    return scheduler.pick([_jobs[job_id] for job_id in _queue],
+                          _running(), _caps, _served)
+
+
+def _order():
+    """Queued jobs in the order they are expected to start.  Call with
+    _lock held.
+    """
+    return scheduler.order([_jobs[job_id] for job_id in _queue],
+                           _running(), _caps, _served)
+
+
+def _running():
+    """Jobs now running, here or on remote workers.  Call with _lock
+    held.
+    """
+    return [job for job in _jobs.values() if job["status"] == "running"]
+
+
+def _take(job, worker):
+    """Start the queued job, on worker (None for a thread of this
+    process).  Call with _lock held.
+    """
+    _queue.remove(job["id"])
+    served = (job["priority"], job["author"])
+    _served[served] = next(_starts)
+    _served.move_to_end(served)
+    while len(_served) > RETAIN:
+        _served.popitem(last=False)
+    job["status"] = "running"
+    job["started"] = time.time()
+    job["worker"] = worker
+    job["heartbeat"] = job["started"]
+    job["attempts"] += 1
+    job["context"]["worker"] = worker
+    return job
+
+
+def _begin(job):
+    log.debug("Starting job %s on %s", job["id"], job["worker"] or "local")
+    trial.trace(job["context"], "job_start", worker=job["worker"],
+                priority=job["priority"],
+                queue_wait=job["started"] - job["submitted"])
+    _record(store.started, job["id"], job["started"])
+
+
+def _end(job, ok, final):
+    """Record the outcome of a job, and let go of its admission."""
+    context = job["context"]
+    with _lock, _output:
+        job["ok"] = ok
+        job["status"] = final
+        job["finished"] = time.time()
+        if _in_flight.get(job["key"]) == job["id"]:
+            del _in_flight[job["key"]]
+        _forget_old()
+        _lock.notify_all()   # Its class may be under its cap again
+        _output.notify_all()
+    log.debug("Finished job %s: %s", job["id"], final)
+    _record(store.finished, job["id"], context, ok, final,
+            job["finished"])
+    if "admission" in context:
+        admission.release(
+            context["admission"],
+            state_file=trial.SETTINGS.get("ADMISSION_FILE",
+                                          admission.ADMISSION_FILE))
+    try:
+        metrics.record_trial(
+            context, ok, queue_wait=job["started"] - job["submitted"],
+            error=(final == "error"),
+            metrics_file=trial.SETTINGS.get("METRICS_FILE",
+                                            metrics.METRICS_FILE))
+    except (OSError, ValueError) as e:
+        log.error("Could not record metrics: %s", e)
+
+
+def _watch_workers(lost_seconds):
+    """Monitor thread: queue again the jobs of lost remote workers."""
+    while True:
+        time.sleep(max(1, lost_seconds / 5))
+        _requeue_lost(lost_seconds)
+
+
+def _requeue_lost(lost_seconds):
+    """Queue again (or fail, after MAX_ATTEMPTS) each job whose remote
+    worker has sent no heartbeat for lost_seconds.
+    """
+    now = time.time()
+    failed = []
+    requeued = []
+    lost = []
+    with _lock:
+        for job in _jobs.values():
+            if (job["status"] != "running" or job["worker"] is None
+                    or now - job["heartbeat"] < lost_seconds):
+                continue
+            log.warning("Worker %s lost job %s", job["worker"], job["id"])
+            _lost[job["worker"]] = now
+            lost.append((job, job["worker"]))
+            if job["attempts"] >= MAX_ATTEMPTS:
+                job["worker"] = None   # So a late result is refused
+                failed.append(job)
+                continue
+            job["status"] = "queued"
+            job["worker"] = None
+            _queue.appendleft(job["id"])
+            _lock.notify_all()
+            requeued.append(job)
+    for job, worker in lost:
+        trial.trace(job["context"], "worker_lost", worker=worker,
+                    attempt=job["attempts"])
+    for job in failed:
+        trial.note(job["context"],
+                   "\n*** Checker failed: worker lost {} times ***\n"
+                   .format(job["attempts"]))
+        _end(job, False, "error")
+    for job in requeued:
+        _emit(job, "\n*** Worker lost; trial queued again ***\n")
+
+
+def _stored_status(job_id):
+    """status() of a job known only to the job store, or None."""
+    try:
+        record = store.get(job_id, path=_store_path())
+    except sqlite3.Error as e:
+        log.error("Could not read job store: %s", e)
+        return None
+    if record is None:
+        return None
+    summary = {name: record[name]
+               for name in ["status", "ok", "submitted", "started",
+                            "finished", "messages", "port", "stages"]}
+    summary.update(id=job_id, position=None)
+    return summary
+
+
+def _record(action, *args):
+    """Record a change of a job in the job store; a failure to record
+    is logged, but does not stop the job.
+    """
+    try:
+        action(*args, path=_store_path())
+    except (sqlite3.Error, OSError) as e:
+        log.error("Could not record job in store: %s", e)
+
+
+def _store_path():
+    return trial.SETTINGS.get("JOB_DB", store.JOB_DB)
+
+
+def _forget_old():
+    """Drop the oldest finished jobs beyond RETAIN.  Call with _lock held."""
+    finished = [job_id for job_id, job in _jobs.items()
+                if job["status"] in ("done", "error")]
+    for job_id in finished[:max(0, len(finished) - RETAIN)]:
+        del _jobs[job_id]
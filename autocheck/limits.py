@@ -0,0 +1,251 @@
+"""
+Resource limits for student code.
+
+Everything a trial runs on a student's behalf (git, 'make install',
+test scripts, the student's server) runs under limits set per stage
+in config.ini, as <stage>_<limit>, e.g., install_memory_mb = 2048:
+   timeout       wall-clock seconds
+   cpu_seconds   CPU time (RLIMIT_CPU)
+   memory_mb     address space of each process (RLIMIT_AS); with
+                 cgroups, memory.max of the whole process tree
+   processes     tasks in the process tree (pids.max); cgroups only,
+                 as RLIMIT_NPROC would count every process of the
+                 user the grader runs as
+A limit of 0 is no limit.  The rlimits are set by running each
+command under prlimit (see Confinement.command).  Commands also run
+niced, and where the ionice command is available, at a lower I/O
+scheduling class.
+
+If cgroup_root names a writable directory in a cgroup v2 hierarchy,
+with the memory and pids controllers enabled for its children, each
+command gets a cgroup of its own below it.  Otherwise only the
+rlimits apply.
+
+A command that breaks a limit is reported as LimitExceeded, with a
+reason, rather than as an ordinary failure.
+"""
+
+import itertools
+import os
+import shutil
+import signal
+import subprocess
+
+import logging
+log = logging.getLogger(__name__)
+
+LIMITS = ["timeout", "cpu_seconds", "memory_mb", "processes"]
+
+# Per stage; "server" is the student's server, started by the spec
+DEFAULTS = {
+    "clone": {"timeout": 120, "cpu_seconds": 60,
+              "memory_mb": 1024, "processes": 64},
+    "install": {"timeout": 600, "cpu_seconds": 300,
+                "memory_mb": 2048, "processes": 256},
+    "test": {"timeout": 15, "cpu_seconds": 30,
+             "memory_mb": 1024, "processes": 128},
+    "server": {"timeout": 0, "cpu_seconds": 300,
+               "memory_mb": 512, "processes": 64},
+    "cleanup": {"timeout": 30, "cpu_seconds": 30,
+                "memory_mb": 512, "processes": 64},
+}
+NICE = 10           # Added to the grader's niceness
+IONICE_CLASS = 3    # Idle; 0 leaves I/O priority alone
+CGROUP_ROOT = ""    # e.g., /sys/fs/cgroup/autocheck; empty for none
+
+# What shells and runtimes say when a limit hits a child process
+_CPU_MARKERS = ["CPU time limit exceeded"]
+_MEMORY_MARKERS = ["MemoryError", "Cannot allocate memory",
+                   "std::bad_alloc", "out of memory"]
+
+_serial = itertools.count()
+
+
+class LimitExceeded(subprocess.CalledProcessError):
+    """A command was stopped for breaking a resource limit.  As a
+    CalledProcessError, it is handled wherever a failed command is.
+    """
+
+    def __init__(self, reason, returncode, cmd, output=None):
+        super().__init__(returncode, cmd, output=output)
+        self.reason = reason
+
+    def __str__(self):
+        return "Command '{}' exceeded its {}".format(self.cmd, self.reason)
+
+
+def for_stage(stage, settings):
+    """Limits for stage, from settings (e.g., the upper case keys of
+    app.config, as INSTALL_MEMORY_MB) or else DEFAULTS.
+    """
+    limits = dict(DEFAULTS.get(stage, {}))
+    for name in LIMITS:
+        key = "{}_{}".format(stage, name).upper()
+        if key in settings:
+            limits[name] = int(settings[key])
+    limits["nice"] = int(settings.get("NICE", NICE))
+    limits["ionice_class"] = int(settings.get("IONICE_CLASS", IONICE_CLASS))
+    limits["cgroup_root"] = settings.get("CGROUP_ROOT", CGROUP_ROOT) or ""
+    return limits
+
+
+def describe(exception):
+    """The limit a failed command (CalledProcessError or
+    TimeoutExpired) broke, as a phrase, or None if it broke none.
+    """
+    if isinstance(exception, LimitExceeded):
+        return exception.reason
+    if isinstance(exception, subprocess.TimeoutExpired):
+        return "wall-clock limit of {} seconds".format(exception.timeout)
+    return None
+
+
+class Confinement:
+    """Limits applied to one command.  Use command() for the arguments
+    to subprocess.Popen, then breach() once the command has finished,
+    and close() to remove its cgroup.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.cgroup = _make_cgroup(limits)
+
+    def command(self, args):
+        """args, prefixed with commands that apply the limits and then
+        exec the next: a shell that joins the cgroup, if there is
+        one, then prlimit, nice, and ionice (where available).  Each
+        keeps the process ID, so that the command's process is the
+        one started.  Setting limits with preexec_fn instead would
+        run Python between fork and exec, which is not safe in a
+        process with threads, and a failure there would raise
+        SubprocessError rather than fail the command.
+        """
+        prefix = []
+        if self.cgroup:
+            prefix += ["sh", "-c", 'echo $$ >"$0" && exec "$@"',
+                       os.path.join(self.cgroup, "cgroup.procs")]
+        rlimits = []
+        cpu = self.limits.get("cpu_seconds", 0)
+        if cpu:
+            # SIGXCPU at the soft limit, SIGKILL a second later
+            rlimits.append("--cpu={}:{}".format(cpu, cpu + 1))
+        memory = self.limits.get("memory_mb", 0)
+        if memory and not self.cgroup:
+            size = memory * 1024 * 1024
+            rlimits.append("--as={}:{}".format(size, size))
+        if rlimits:
+            if shutil.which("prlimit"):
+                prefix += ["prlimit"] + rlimits + ["--"]
+            else:
+                log.warning("No prlimit command; CPU and memory"
+                            " limits not applied")
+        if self.limits.get("nice") and shutil.which("nice"):
+            prefix += ["nice", "-n", str(self.limits["nice"])]
+        io_class = self.limits.get("ionice_class", 0)
+        if io_class and shutil.which("ionice"):
+            prefix += ["ionice", "-c", str(io_class)]
+        return prefix + list(args)
+
+    def breach(self, returncode, output=""):
+        """The limit the finished command broke, or None."""
+        if self.cgroup:
+            if _event(self.cgroup, "memory.events", "oom_kill"):
+                return "memory limit of {} MB".format(
+                    self.limits["memory_mb"])
+            if _event(self.cgroup, "pids.events", "max"):
+                return "limit of {} processes".format(
+                    self.limits["processes"])
+        if not returncode:
+            return None
+        if self.limits.get("cpu_seconds"):
+            if returncode == -signal.SIGXCPU or any(
+                    marker in output for marker in _CPU_MARKERS):
+                return "CPU limit of {} seconds".format(
+                    self.limits["cpu_seconds"])
+        if self.limits.get("memory_mb") and not self.cgroup:
+            if any(marker in output for marker in _MEMORY_MARKERS):
+                return "memory limit of {} MB".format(
+                    self.limits["memory_mb"])
+        return None
+
+    def kill(self):
+        """Kill everything in the command's cgroup, if it has one."""
+        if self.cgroup:
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.kill"), "w") as f:
+                    f.write("1")
+            except OSError as e:
+                log.warning("Could not kill cgroup %s: %s",
+                            self.cgroup, e)
+
+    def close(self):
+        """Remove the cgroup, unless processes (e.g., a server started
+        in the background) are still in it; sweep() removes it later.
+        """
+        if self.cgroup:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                pass
+
+
+def sweep(limits):
+    """Remove cgroups left by earlier commands that are now empty."""
+    root = limits.get("cgroup_root")
+    if not root or not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith("cmd-") and os.path.isdir(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass   # Still in use
+
+
+def _make_cgroup(limits):
+    """A new cgroup below limits["cgroup_root"] with the memory and
+    process limits set, or None if cgroups are not available.
+    """
+    root = limits.get("cgroup_root")
+    if not root:
+        return None
+    path = os.path.join(root, "cmd-{}-{}".format(os.getpid(), next(_serial)))
+    try:
+        os.makedirs(path)
+        if limits.get("memory_mb"):
+            _write(path, "memory.max", limits["memory_mb"] * 1024 * 1024)
+            _write(path, "memory.swap.max", 0)
+        if limits.get("processes"):
+            _write(path, "pids.max", limits["processes"])
+        return path
+    except OSError as e:
+        log.warning("No cgroup under %s (%s); using rlimits only",
+                    root, e)
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        return None
+
+
+def _write(cgroup, name, value):
+    try:
+        with open(os.path.join(cgroup, name), "w") as f:
+            f.write(str(value))
+    except FileNotFoundError:
+        if name != "memory.swap.max":   # Absent without swap accounting
+            raise
+
+
+def _event(cgroup, name, counter):
+    """Count of counter in the cgroup's events file name."""
+    try:
+        with open(os.path.join(cgroup, name)) as f:
+            for line in f:
+                key, _, count = line.partition(" ")
+                if key == counter:
+                    return int(count)
+    except (OSError, ValueError):
+        pass
+    return 0
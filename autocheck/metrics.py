@@ -0,0 +1,167 @@
+"""
+Counters and histograms of where trial time goes, for /metrics.
+
+Measurements are kept in one JSON file shared by all gunicorn worker
+processes (see shared.py), so that the totals are right no matter
+which worker ran a trial or which one answers the scrape.  render()
+formats them in the Prometheus text exposition format.
+
+Recorded for each trial:
+   autocheck_trials_total{result}                 ok, failed, error, cached
+   autocheck_queue_wait_seconds                   histogram
+   autocheck_stage_seconds{stage}                 histogram per stage
+   autocheck_stage_total{stage,result}            ok, failed, skipped
+   autocheck_output_bytes                         histogram of log size
+and for each upload refused by admission control (see admission.py),
+or rejected by the pre-flight checks (see preflight.py):
+   autocheck_refused_total{reason}                author, repo, address,
+                                                  in_flight, preflight
+"""
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+METRICS_FILE = "/tmp/,metrics/metrics.json"
+
+SECONDS_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300]
+BYTES_BUCKETS = [1024 * 4 ** n for n in range(8)]   # 1K .. 16M
+
+HELP = {
+    "autocheck_trials_total": ("counter", "Trials finished, by result"),
+    "autocheck_queue_wait_seconds": ("histogram",
+                                     "Time from submission to start"),
+    "autocheck_stage_seconds": ("histogram", "Wall-clock time per stage"),
+    "autocheck_stage_total": ("counter", "Stages finished, by result"),
+    "autocheck_output_bytes": ("histogram", "Size of each trial's log"),
+    "autocheck_refused_total": ("counter", "Uploads refused, by limit"),
+    "autocheck_cache_hits_total": ("counter", "Cache hits, by cache"),
+    "autocheck_cache_misses_total": ("counter", "Cache misses, by cache"),
+    "autocheck_cache_evictions_total": ("counter",
+                                        "Cache entries evicted, by cache"),
+}
+
+
+def record_trial(context, ok, queue_wait=None, error=False,
+                 metrics_file=METRICS_FILE):
+    """Record the measurements of one finished trial."""
+    if error:
+        result = "error"
+    elif context.get("cached"):
+        result = "cached"
+    else:
+        result = "ok" if ok else "failed"
+    with shared.updating(metrics_file, {}) as state:
+        _count(state, "autocheck_trials_total", {"result": result})
+        if queue_wait is not None:
+            _observe(state, "autocheck_queue_wait_seconds", {},
+                     queue_wait, SECONDS_BUCKETS)
+        if not context.get("cached"):
+            for stage, outcome in context.get("stages", {}).items():
+                _record_stage(state, stage, outcome)
+            if "output_bytes" in context:
+                _observe(state, "autocheck_output_bytes", {},
+                         context["output_bytes"], BYTES_BUCKETS)
+
+
+def record_stage(stage, outcome, metrics_file=METRICS_FILE):
+    """Record one stage run outside a trial (e.g., shutdown);
+    outcome is as in context["stages"].
+    """
+    with shared.updating(metrics_file, {}) as state:
+        _record_stage(state, stage, outcome)
+
+
+def record_refusal(reason, metrics_file=METRICS_FILE):
+    """Record an upload refused by admission control or pre-flight."""
+    with shared.updating(metrics_file, {}) as state:
+        _count(state, "autocheck_refused_total", {"reason": reason})
+
+
+def render(metrics_file=METRICS_FILE):
+    """All metrics in Prometheus text format."""
+    state = shared.read_json(metrics_file, {})
+    lines = []
+    for name in sorted(state):
+        kind, text = HELP.get(name, ("untyped", name))
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in sorted(state[name].items()):
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, _braces(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(value["bounds"] + ["+Inf"],
+                                    value["buckets"]):
+                cumulative += count
+                le = 'le="{}"'.format(bound)
+                lines.append("{}_bucket{} {}".format(
+                    name, _braces(",".join(filter(None, [labels, le]))),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(name, _braces(labels),
+                                              value["sum"]))
+            lines.append("{}_count{} {}".format(name, _braces(labels),
+                                                value["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def render_caches(caches):
+    """Hit and miss counters of caches, a dict from cache name to its
+    stats (as from mirrors.stats or envcache.stats), in Prometheus
+    text format.
+    """
+    lines = []
+    for counter in ["hits", "misses", "evictions"]:
+        name = "autocheck_cache_{}_total".format(counter)
+        kind, text = HELP[name]
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for cache in sorted(caches):
+            lines.append('{}{{cache="{}"}} {}'.format(
+                name, cache, caches[cache].get(counter, 0)))
+    return "\n".join(lines) + "\n"
+
+
+def _record_stage(state, stage, outcome):
+    if outcome["ok"] is None:
+        _count(state, "autocheck_stage_total",
+               {"stage": stage, "result": "skipped"})
+        return
+    _count(state, "autocheck_stage_total",
+           {"stage": stage, "result": "ok" if outcome["ok"] else "failed"})
+    _observe(state, "autocheck_stage_seconds", {"stage": stage},
+             outcome["seconds"], SECONDS_BUCKETS)
+
+
+def _labels(labels):
+    """Labels in exposition form, e.g., 'stage="clone"', as a dict key."""
+    return ",".join('{}="{}"'.format(name, labels[name])
+                    for name in sorted(labels))
+
+
+def _braces(labels):
+    return "{" + labels + "}" if labels else ""
+
+
+def _count(state, name, labels, amount=1):
+    series = state.setdefault(name, {})
+    key = _labels(labels)
+    series[key] = series.get(key, 0) + amount
+
+
+def _observe(state, name, labels, value, bounds):
+    series = state.setdefault(name, {})
+    key = _labels(labels)
+    histogram = series.setdefault(key, {"bounds": bounds,
+                                        "buckets": [0] * (len(bounds) + 1),
+                                        "sum": 0.0,
+                                        "count": 0})
+    for i, bound in enumerate(histogram["bounds"]):
+        if value <= bound:
+            break
+    else:
+        i = len(histogram["bounds"])
+    histogram["buckets"][i] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
@@ -0,0 +1,122 @@
+"""
+Local cache of bare mirrors of student repositories.
+
+Students often resubmit the same repository many times before a
+deadline.  Rather than a full 'git clone' from the remote each time,
+we keep a bare mirror of each remote (keyed by its URL).  The first
+trial of a repository creates the mirror; later trials only fetch
+objects that are new since the last one.  The working copy for a
+trial is then a depth-1 clone from the local mirror, which is fast
+and does not depend on the mirror afterward (so a mirror can be
+evicted while a trial is still using its clone).
+
+The cache is capped in size; when it grows past the cap, the least
+recently used mirrors are removed.  Hits and misses are counted in
+stats.json in the cache directory, shared by all worker processes.
+"""
+
+import hashlib
+import os
+import shutil
+
+import runner
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+MIRROR_DIR = "/tmp/,mirrors"
+MIRROR_CACHE_MB = 500
+
+
+def mirror_path(remote, cache_dir=MIRROR_DIR):
+    """Where the mirror of remote lives (whether or not it exists yet)."""
+    key = hashlib.sha1(remote.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, key + ".git")
+
+
+async def clone(remote, clone_path, cache_dir=MIRROR_DIR, limits=None):
+    """Make a working copy of remote at clone_path by way of the
+    local mirror, creating or refreshing the mirror as needed; a
+    coroutine, with git run as asyncio subprocesses.  Each git
+    command runs under limits (see limits.py), if given.  Returns
+    the git output.  Raises subprocess.CalledProcessError as 'git
+    clone' would, or subprocess.TimeoutExpired.  The caller should
+    evict() afterward, keeping mirror_path(remote).
+    """
+    mirror = mirror_path(remote, cache_dir)
+    async with shared.locked_async(mirror):
+        if os.path.isdir(mirror):
+            hit = True
+            gitlog = await _git(["git", "--git-dir", mirror,
+                                 "remote", "update", "--prune"],
+                                limits=limits)
+        else:
+            hit = False
+            shutil.rmtree(mirror + ".new", ignore_errors=True)
+            gitlog = await _git(["git", "clone", "--mirror", remote,
+                                 mirror + ".new"], limits=limits)
+            os.rename(mirror + ".new", mirror)
+        os.utime(mirror)   # Most recently used
+        gitlog += await _git(["git", "clone", "--depth", "1",
+                              "file://" + mirror, clone_path],
+                             limits=limits)
+    # Point the working copy back at the real remote
+    await _git(["git", "remote", "set-url", "origin", remote],
+               cwd=clone_path, limits=limits)
+    _count("hits" if hit else "misses", cache_dir)
+    log.debug("Mirror %s for %s (%s)",
+              mirror, remote, "hit" if hit else "miss")
+    return "(local mirror {})\n".format("refreshed" if hit else "created") \
+        + gitlog
+
+
+def evict(cache_dir=MIRROR_DIR, cap_mb=MIRROR_CACHE_MB, keep=None):
+    """Remove least recently used mirrors until the cache is within
+    cap_mb megabytes.  Mirrors in use by another trial are skipped.
+    """
+    mirrors = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".git") and os.path.isdir(path) and path != keep:
+            mirrors.append((os.stat(path).st_mtime, path))
+    total = sum(shared.tree_size(path) for _, path in mirrors)
+    if keep:
+        total += shared.tree_size(keep)
+    cap = cap_mb * 1024 * 1024
+    for _, path in sorted(mirrors):
+        if total <= cap:
+            break
+        with shared.locked(path, blocking=False) as got_it:
+            if not got_it:
+                continue
+            size = shared.tree_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            _count("evictions", cache_dir)
+            log.info("Evicted mirror %s (%s bytes)", path, size)
+
+
+def stats(cache_dir=MIRROR_DIR):
+    """Dict of hits, misses, evictions, mirror count and total bytes."""
+    counts = shared.read_json(os.path.join(cache_dir, "stats.json"), {})
+    result = {"hits": counts.get("hits", 0),
+              "misses": counts.get("misses", 0),
+              "evictions": counts.get("evictions", 0)}
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else None
+    mirrors = [os.path.join(cache_dir, name)
+               for name in os.listdir(cache_dir)
+               if name.endswith(".git")] if os.path.isdir(cache_dir) else []
+    result["mirrors"] = len(mirrors)
+    result["bytes"] = sum(shared.tree_size(path) for path in mirrors)
+    return result
+
+
+def _count(counter, cache_dir):
+    with shared.updating(os.path.join(cache_dir, "stats.json"), {}) as counts:
+        counts[counter] = counts.get(counter, 0) + 1
+
+
+async def _git(args, cwd=None, limits=None):
+    return await runner.run_async(args, cwd=cwd, limits=limits)
@@ -0,0 +1,88 @@
+"""
+Leases on TCP ports for student servers.
+
+Each trial starts a student server on a port of its own.  Picking a
+port at random is not enough when several trials run at once, or
+when a server from an earlier trial is still running: the new server
+fails to bind, and the trial fails for no fault of the student.
+
+Instead a trial takes a lease on a port.  A port is leased only if
+no other live lease holds it and we can actually bind it right now.
+Leases are recorded in a JSON file shared by all worker processes
+(see shared.py), and end when released (by trial.shutdown) or when
+they expire.
+"""
+
+import os
+import random
+import socket
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+PORT_LOW = 8500
+PORT_HIGH = 9999      # Exclusive
+LEASE_SECONDS = 900   # A lease outlives the trial, for manual testing
+LEASE_FILE = "/tmp/,ports/leases.json"
+
+
+def lease(holder, low=PORT_LOW, high=PORT_HIGH,
+          seconds=LEASE_SECONDS, lease_file=LEASE_FILE):
+    """Lease a free port to holder (e.g., a job ID) for the given
+    number of seconds.  Returns the port as an int, or None if every
+    port in range(low, high) is leased or in use.
+    """
+    now = time.time()
+    with shared.updating(lease_file, {}) as leases:
+        for port in list(leases):
+            if leases[port]["expires"] < now:
+                log.debug("Lease on port %s expired", port)
+                del leases[port]
+        candidates = list(range(low, high))
+        # Start somewhere random so that we do not always
+        # probe the same (probably busy) low ports first
+        start = random.randrange(len(candidates))
+        for port in candidates[start:] + candidates[:start]:
+            if str(port) in leases or not is_free(port):
+                continue
+            leases[str(port)] = {"holder": holder,
+                                 "pid": os.getpid(),
+                                 "expires": now + seconds}
+            log.debug("Leased port %s to %s", port, holder)
+            return port
+    log.warning("No free port in range %s-%s", low, high)
+    return None
+
+
+def release(holder, lease_file=LEASE_FILE):
+    """End all leases held by holder.  Returns the ports released."""
+    with shared.updating(lease_file, {}) as leases:
+        ports = [port for port in leases
+                 if leases[port]["holder"] == holder]
+        for port in ports:
+            del leases[port]
+    log.debug("Released ports %s from %s", ports, holder)
+    return [int(port) for port in ports]
+
+
+def leases(lease_file=LEASE_FILE):
+    """Current unexpired leases, as a dict from port (int) to lease."""
+    now = time.time()
+    return {int(port): held
+            for port, held in shared.read_json(lease_file, {}).items()
+            if held["expires"] >= now}
+
+
+def is_free(port):
+    """Can a server bind this port right now?"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("0.0.0.0", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
@@ -0,0 +1,153 @@
+"""
+Pre-flight checks of a submission, before any workspace, clone, or
+trial slot is spent on it.
+
+The uploaded credentials file is checked in memory: it must be no
+larger than MAX_UPLOAD_BYTES, be a readable .ini file, and give a
+value for each credential field the project requires.  Those are
+listed in config.ini, as credential_fields in the section for the
+project (named for it, e.g., [proj1], or as [Project 1]) or else in
+[DEFAULT]; CREDENTIAL_FIELDS if neither says.  Then the repository
+must be reachable: 'git ls-remote' must find it.  Reachability is
+remembered for REACHABLE_SECONDS (UNREACHABLE_SECONDS if it was not
+reachable, so a student who has just fixed the repository need not
+wait long), in a file shared by all worker processes (see shared.py),
+so a resubmission costs no network round trip.  When git is asked,
+the commit at the repository's HEAD comes with the answer, and is
+passed on so that it need not be asked for again.
+"""
+
+import configparser
+import os
+import re
+import subprocess
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+CREDENTIAL_FIELDS = ["author", "repo"]
+MAX_UPLOAD_BYTES = 64 * 1024   # 64K is plenty for a config file
+REACHABLE_FILE = "/tmp/,preflight/reachable.json"
+REACHABLE_SECONDS = 600
+UNREACHABLE_SECONDS = 30
+LS_REMOTE_TIMEOUT = 10   # Seconds
+
+
+class Rejected(ValueError):
+    """A submission that cannot succeed; the message says why."""
+
+
+def fields_by_project(config_path):
+    """Credential fields required for each project section of the
+    configuration file at config_path, as a dict from section name
+    to list of field names, with "DEFAULT" for the rest.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    fields = {}
+    for section in ["DEFAULT"] + config.sections():
+        listed = config[section].get("credential_fields")
+        if listed:
+            fields[section] = [field.strip() for field in listed.split(",")
+                               if field.strip()]
+    return fields
+
+
+def fields_for(project, fields_by_section):
+    """Credential fields required for project (e.g., "proj1"), from
+    the result of fields_by_project.
+    """
+    number = re.fullmatch(r"proj(\d+)", project)
+    names = [project]
+    if number:
+        names.append("Project {}".format(number.group(1)))
+    for name in names + ["DEFAULT"]:
+        if name in fields_by_section:
+            return fields_by_section[name]
+    return CREDENTIAL_FIELDS
+
+
+def check_credentials(data, fields, max_bytes=MAX_UPLOAD_BYTES):
+    """The credentials in data (bytes of an uploaded .ini file) as a
+    dict of fields, if it has every one of them.  Raises Rejected if
+    not, or if data is larger than max_bytes or is not an .ini file.
+    """
+    if max_bytes and len(data) > max_bytes:
+        raise Rejected("Credentials file is {} bytes; the limit is {}"
+                       .format(len(data), max_bytes))
+    config = configparser.ConfigParser()
+    try:
+        config.read_string(data.decode("utf-8"))
+    except (UnicodeDecodeError, configparser.Error) as e:
+        raise Rejected("Credentials file could not be read: {}"
+                       .format(str(e).splitlines()[0]))
+    settings = {}
+    missing = []
+    for field in fields:
+        value = config["DEFAULT"].get(field, "").strip()
+        if value:
+            settings[field] = value
+        else:
+            missing.append(field)
+    if missing:
+        raise Rejected("Credentials file has no {} (in its [DEFAULT]"
+                       " section)".format(", ".join(missing)))
+    return settings
+
+
+def check_reachable(repo, cache_file=REACHABLE_FILE,
+                    timeout=LS_REMOTE_TIMEOUT):
+    """Raise Rejected unless git can list repo (a remote, as git
+    clone would take it), as found by 'git ls-remote' now or lately.
+    Returns the commit at HEAD of repo if git was asked just now,
+    else None.
+    """
+    now = time.time()
+    known = shared.read_json(cache_file, {}).get(repo) if cache_file \
+        else None
+    head = None
+    if known and known["until"] > now:
+        reachable, reason = known["ok"], known["reason"]
+    else:
+        reachable, reason, head = _ls_remote(repo, timeout)
+        if cache_file:
+            seconds = REACHABLE_SECONDS if reachable else UNREACHABLE_SECONDS
+            with shared.updating(cache_file, {}) as cache:
+                for other in [other for other, entry in cache.items()
+                              if entry["until"] <= now]:
+                    del cache[other]
+                cache[repo] = {"ok": reachable, "reason": reason,
+                               "until": now + seconds}
+    if not reachable:
+        raise Rejected("Repository {} could not be reached: {}"
+                       .format(repo, reason))
+    return head
+
+
+def _ls_remote(repo, timeout):
+    """(True, None, commit at HEAD or None) if git can list repo,
+    else (False, why not, None).
+    """
+    if repo.startswith("-"):
+        return False, "not a repository URL", None
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    try:
+        listed = subprocess.run(["git", "ls-remote", "--", repo, "HEAD"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                stdin=subprocess.DEVNULL, env=env,
+                                timeout=timeout, check=True,
+                                universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        lines = (e.stderr or "").strip().splitlines()
+        return False, lines[0] if lines else "git ls-remote failed", None
+    except subprocess.TimeoutExpired:
+        return False, "no answer within {} seconds".format(timeout), None
+    except OSError as e:
+        log.warning("Could not run git ls-remote: %s", e)
+        return True, None, None   # Our problem, not the student's
+    fields = listed.stdout.split()
+    return True, None, fields[0] if fields else None
@@ -0,0 +1,151 @@
+"""
+Check a student's web server from Python.
+
+Rather than sleeping for a fixed time and hoping the server has
+started, we probe its port until it accepts connections (or a
+deadline passes).  Then we issue the HTTP checks for the project
+concurrently, each worker thread reusing one keep-alive connection,
+and report for each check the status code we got and whether the
+body matched, rather than raw curl output.
+
+Checks are read from an .ini file, one section per check:
+   [sample page]
+   path = /simple_page.html
+   status = 200
+   body = Simple page       (optional regular expression)
+"""
+
+import asyncio
+import concurrent.futures
+import configparser
+import http.client
+import re
+import socket
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+PROBE_SECONDS = 10     # How long a server may take to start
+REQUEST_TIMEOUT = 5    # Seconds, per request
+CHECK_WORKERS = 4      # Checks at once
+
+
+async def wait_for_port(port, host="localhost", seconds=PROBE_SECONDS,
+                        give_up=None):
+    """Wait until something accepts connections on port, for up to
+    seconds, or until give_up() (if given) returns True.  Returns
+    the time it took, or None if it never did.  A coroutine, so
+    waiting takes no thread.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + seconds
+    # Look host up once, here, rather than in a thread on every try
+    try:
+        addresses = [address[0] for *_, address in socket.getaddrinfo(
+            host, int(port), type=socket.SOCK_STREAM)]
+    except OSError:
+        addresses = [host]
+    while True:
+        for address in addresses:
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, int(port)), 1)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            writer.close()
+            return loop.time() - started
+        if loop.time() >= deadline or (give_up and give_up()):
+            return None
+        await asyncio.sleep(0.1)
+
+
+def read_checks(path):
+    """List of checks (dicts with name, path, status, body) from
+    an .ini file.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    return [check_from(name, config[name]) for name in config.sections()]
+
+
+def check_from(name, section):
+    """A check described by one section of a configuration file."""
+    return {"name": name,
+            "path": section.get("path", "/"),
+            "status": section.getint("status", 200),
+            "body": section.get("body")}
+
+
+def run_checks(port, checks, host="localhost", workers=CHECK_WORKERS,
+               timeout=REQUEST_TIMEOUT):
+    """Run the checks against the server on port, concurrently.
+    Returns a list of results in the same order as checks, each the
+    check dict plus "got" (status code or None), "body_ok",
+    "error" (None or a message), and "ok".
+    """
+    local = threading.local()
+    opened = []    # Every connection, so all are closed at the end
+
+    def connection():
+        if getattr(local, "connection", None) is None:
+            local.connection = http.client.HTTPConnection(
+                host, int(port), timeout=timeout)
+            opened.append(local.connection)
+        return local.connection
+
+    def run_one(check):
+        result = dict(check, got=None, body_ok=None, error=None)
+        for attempt in range(2):
+            try:
+                conn = connection()
+                conn.request("GET", check["path"])
+                response = conn.getresponse()
+                body = response.read().decode("utf-8", errors="replace")
+                if response.getheader("Connection", "").lower() == "close":
+                    conn.close()
+                    local.connection = None
+                result["got"] = response.status
+                result["error"] = None
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # The server may have closed a kept-alive connection;
+                # try once more on a fresh one
+                if local.connection is not None:
+                    local.connection.close()
+                local.connection = None
+                result["error"] = str(e) or type(e).__name__
+        else:
+            result["ok"] = False
+            return result
+        if check["body"]:
+            result["body_ok"] = re.search(check["body"], body) is not None
+        result["ok"] = (result["got"] == check["status"]
+                        and result["body_ok"] is not False)
+        return result
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(run_one, checks))
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+def report(results):
+    """Readable lines describing check results."""
+    lines = []
+    for result in results:
+        verdict = "PASS" if result["ok"] else "FAIL"
+        if result["error"]:
+            outcome = "no response ({})".format(result["error"])
+        else:
+            outcome = "status {}".format(result["got"])
+        line = "{} {}: GET {} -> {} (expected {})".format(
+            verdict, result["name"], result["path"], outcome,
+            result["status"])
+        if result["body_ok"] is False:
+            line += "; body does not match /{}/".format(result["body"])
+        lines.append(line)
+    return lines
@@ -0,0 +1,113 @@
+"""
+Cache of trial results, keyed by what was tested.
+
+If a student resubmits without pushing anything new, another trial
+would clone, install, and test exactly the same commit again.  The
+outcome of a trial depends only on the commit, the project and
+application being checked, the test suite for that project
+(tests/projN), and the credentials file uploaded (which, from project
+2 on, changes how the application installs and runs), so we remember
+results under those.  Finding the
+commit at the head of a remote costs only a 'git ls-remote'.
+
+Each result is a JSON file in the cache directory, beside a copy of
+the trial's full (compressed) log.  Both are removed RESULT_KEEP_DAYS
+after they were stored (see trial.reap_expired), and the commit is
+then tried again if resubmitted.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+RESULT_DIR = "/tmp/,results"
+RESULT_KEEP_DAYS = 30
+LS_REMOTE_TIMEOUT = 20   # Seconds
+
+
+def remote_head(remote, timeout=LS_REMOTE_TIMEOUT):
+    """The commit SHA at HEAD of remote, or None if we can't tell."""
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-remote", "--", remote, "HEAD"],
+            stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+            env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+            timeout=timeout,
+            universal_newlines=True)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+            OSError) as exception:
+        log.debug("ls-remote %s failed: %s", remote, exception)
+        return None
+    fields = output.split()
+    return fields[0] if fields else None
+
+
+def checked_out(clone_path):
+    """The commit SHA checked out in clone_path, or None."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=clone_path,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def credentials_version(path):
+    """Hash of the contents of an uploaded credentials file."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def suite_version(test_path):
+    """Hash of the names and contents of the files in a test suite
+    directory, so that changing the tests invalidates old results.
+    """
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(test_path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, test_path).encode("utf-8"))
+            digest.update(b"\0")
+            with open(path, "rb") as f:
+                digest.update(f.read())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def key(repo, commit, project, app, suite, credentials):
+    """Cache key for one combination of what a trial tests; suite and
+    credentials as from suite_version and credentials_version.
+    """
+    return hashlib.sha256("\n".join([repo, commit, project, app, suite,
+                                     credentials])
+                          .encode("utf-8")).hexdigest()
+
+
+def lookup(result_key, result_dir=RESULT_DIR):
+    """The stored result for result_key, or None."""
+    return shared.read_json(os.path.join(result_dir, result_key + ".json"))
+
+
+def store(result_key, result, log_path=None, result_dir=RESULT_DIR):
+    """Remember result (a JSON-able dict) under result_key, with a
+    copy of the log at log_path if given.  Returns the stored dict.
+    """
+    os.makedirs(result_dir, exist_ok=True)
+    result = dict(result, stored=time.time())
+    if log_path and os.path.exists(log_path):
+        kept = os.path.join(result_dir, result_key + ".log.gz")
+        shutil.copyfile(log_path, kept)
+        result["log_path"] = kept
+    shared.write_json(os.path.join(result_dir, result_key + ".json"), result)
+    log.debug("Stored result %s", result_key)
+    return result
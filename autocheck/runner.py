@@ -0,0 +1,131 @@
+"""
+Run a command as subprocess.check_output would (standard error merged
+into standard output, text rather than bytes), but hand the output to
+a callback as soon as it is produced, so that progress can be shown
+while a long 'make install' is still running.
+
+run_async() is a coroutine, run in an asyncio event loop, so that one
+thread can supervise many commands at once (see trial.trial_async).
+"""
+
+import asyncio
+import codecs
+import io
+import locale
+import os
+import signal
+import subprocess
+
+import limits as resource_limits
+import spool
+
+import logging
+log = logging.getLogger(__name__)
+
+READ_SIZE = 4096   # Bytes of output read at a time by run_async
+
+
+async def run_async(args, cwd=None, timeout=None, emit=None, keep=None,
+                    new_session=False, on_start=None, limits=None):
+    """Run args in directory cwd, as an asyncio subprocess, passing
+    the output to emit (if given) in pieces as they arrive, not
+    necessarily whole lines.  Returns the output, or if keep is given,
+    only its first and last keep/2 characters.
+    With new_session, the command leads a session (and process group)
+    of its own.  on_start, if given, is called with the process as
+    soon as it has started.  limits, if given, are resource limits as
+    from limits.for_stage; their timeout applies if timeout is not
+    given.
+    Raises subprocess.CalledProcessError on a non-zero exit (or
+    limits.LimitExceeded, if a limit was broken), or
+    subprocess.TimeoutExpired if it runs longer than timeout seconds
+    (the process is then killed).  Either carries the output so far.
+    If the task running it is cancelled, the command (and its process
+    group or cgroup, if it has one) is killed.
+    """
+    log.debug("Running %s in %s", args, cwd)
+    confinement = None
+    if limits:
+        confinement = resource_limits.Confinement(limits)
+        timeout = timeout or limits.get("timeout") or None
+    try:
+        return await _run_async(args, cwd, timeout, emit, keep,
+                                new_session, on_start, confinement)
+    finally:
+        if confinement:
+            confinement.close()
+
+
+async def _run_async(args, cwd, timeout, emit, keep, new_session, on_start,
+                     confinement):
+    process = await asyncio.create_subprocess_exec(
+        *(confinement.command(args) if confinement else args),
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=new_session)
+    if on_start:
+        on_start(process)
+    # Decode as universal_newlines does, in pieces as they arrive
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+        translate=True)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+    if keep:
+        output = spool.Spool(head=keep // 2, tail=keep // 2)
+    else:
+        output = spool.Spool(head=None)
+    try:
+        while True:
+            wait = max(0, deadline - loop.time()) if deadline else None
+            try:
+                chunk = await asyncio.wait_for(
+                    process.stdout.read(READ_SIZE), wait)
+            except asyncio.TimeoutError:
+                _stop(process, confinement, new_session)
+                await process.wait()
+                raise subprocess.TimeoutExpired(args, timeout,
+                                                output=output.text())
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                output.write(text)
+                if emit:
+                    emit(text)
+            if not chunk:
+                break
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        _stop(process, confinement, new_session)
+        raise
+    return _outcome(args, returncode, output.text(), confinement)
+
+
+def _outcome(args, returncode, output, confinement):
+    """output, or the exception to raise for returncode."""
+    reason = confinement.breach(returncode, output) if confinement else None
+    if reason:
+        raise resource_limits.LimitExceeded(reason, returncode, args,
+                                            output=output)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args, output=output)
+    return output
+
+
+def _stop(process, confinement, new_session):
+    """Kill a command's process, with its cgroup and group if any."""
+    if confinement:
+        confinement.kill()
+    if new_session:
+        _kill_group(process.pid)
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
@@ -0,0 +1,227 @@
+"""
+Supervision of trial sandboxes: clone directories and the processes
+(student servers) started in them.
+
+A trial leaves the student's server running so that it can be tried
+by hand.  Each trial's clone directory and the process groups it
+started are registered here, in a file shared by all worker processes
+(see shared.py).  A sandbox is torn down, by killing its process
+groups and removing its clone directory, when the trial is shut down
+(/_kill), or by the reaper once it has outlived its time to live,
+which starts when the trial finishes (finish()).  A sandbox whose
+trial is still running is never reaped, unless it has been running
+for ABANDONED seconds, longer than any trial could: then whatever
+was running it has died.
+
+Student servers are started in a session of their own, so that
+killing the process group also gets any children they forked.  The
+start time of each group's leader is registered with it, so that a
+group ID reused by some later process (after the whole group has
+gone) is not killed in its place.  Zombies count as gone: a server
+that exits is not always waited for by the process that started it.
+"""
+
+import os
+import shutil
+import signal
+import threading
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+REGISTRY = "/tmp/,sandboxes/registry.json"
+TTL = 600          # Seconds a sandbox may live after its trial ends
+ABANDONED = 6 * 3600   # Seconds after which a trial cannot be running
+REAP_EVERY = 30    # Seconds between reaper passes
+GRACE = 2          # Seconds between SIGTERM and SIGKILL
+
+
+def register(holder, clone_path, registry=REGISTRY, **info):
+    """Record a new sandbox for holder (e.g., a job ID), whose trial
+    is running.  Extra info (project, port, ...) is kept for listing.
+    """
+    with shared.updating(registry, {}) as sandboxes:
+        sandboxes[holder] = dict(info, clone_path=clone_path,
+                                 pgids=[], started=time.time(),
+                                 expires=None)
+
+
+def finish(holder, ttl=TTL, registry=REGISTRY):
+    """holder's trial has finished: tear its sandbox down after ttl
+    seconds, if it is not shut down before then.
+    """
+    with shared.updating(registry, {}) as sandboxes:
+        if holder in sandboxes:
+            sandboxes[holder]["expires"] = time.time() + ttl
+
+
+def add_group(holder, pgid, registry=REGISTRY):
+    """Note that process group pgid (led by the process with that ID)
+    belongs to holder's sandbox.
+    """
+    start = process_start(pgid)
+    with shared.updating(registry, {}) as sandboxes:
+        if holder in sandboxes:
+            sandboxes[holder]["pgids"].append(pgid)
+            sandboxes[holder].setdefault("starts", {})[str(pgid)] = start
+        else:
+            log.warning("Process group %s for unknown sandbox %s",
+                        pgid, holder)
+
+
+def release(holder, registry=REGISTRY):
+    """Tear down holder's sandbox: kill its processes and remove its
+    clone directory.  Returns what was registered for it, or None if
+    there was no such sandbox.
+    """
+    with shared.updating(registry, {}) as sandboxes:
+        sandbox = sandboxes.pop(holder, None)
+    if sandbox is None:
+        return None
+    for pgid in sandbox["pgids"]:
+        kill_group(pgid, start=sandbox.get("starts", {}).get(str(pgid)))
+    shutil.rmtree(sandbox["clone_path"], ignore_errors=True)
+    log.info("Released sandbox %s (%s)", holder, sandbox["clone_path"])
+    return sandbox
+
+
+def expired(registry=REGISTRY):
+    """Holders of sandboxes past their time to live, or abandoned."""
+    now = time.time()
+    return [holder
+            for holder, sandbox in shared.read_json(registry, {}).items()
+            if (sandbox["expires"] or sandbox["started"] + ABANDONED) < now]
+
+
+def live(registry=REGISTRY):
+    """Registered sandboxes, each a dict of what was registered plus
+    "holder", "processes", "rss_bytes" and "cpu_seconds" in use now.
+    """
+    sandboxes = shared.read_json(registry, {})
+    usage = group_usage()
+    listing = []
+    for holder, sandbox in sorted(sandboxes.items(),
+                                  key=lambda item: item[1]["started"]):
+        entry = dict(sandbox, holder=holder, processes=0,
+                     rss_bytes=0, cpu_seconds=0.0)
+        for pgid in sandbox["pgids"]:
+            for name, amount in usage.get(pgid, {}).items():
+                entry[name] += amount
+        listing.append(entry)
+    return listing
+
+
+def start_reaper(every=REAP_EVERY, reap=None):
+    """Start a thread that calls reap() (by default, releasing each
+    expired sandbox) every so many seconds.
+    """
+    def release_expired():
+        for holder in expired():
+            release(holder)
+
+    def reaper():
+        while True:
+            time.sleep(every)
+            try:
+                (reap or release_expired)()
+            except Exception as e:
+                log.error("Reaper failed: %s", e)
+
+    thread = threading.Thread(target=reaper, name="reaper", daemon=True)
+    thread.start()
+    return thread
+
+
+def kill_group(pgid, grace=GRACE, start=None):
+    """Terminate process group pgid, killing it if it lingers.  If
+    start (its leader's start time, as from process_start) is given,
+    a group that is no longer the one registered is left alone.
+    """
+    if start is not None and not _same_group(pgid, start):
+        log.info("Process group %s has already gone", pgid)
+        return
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            return
+        except PermissionError as e:
+            log.error("Cannot signal process group %s: %s", pgid, e)
+            return
+        deadline = time.time() + grace
+        while time.time() < deadline:
+            if not _group_alive(pgid):
+                return
+            time.sleep(0.1)
+    log.warning("Process group %s survived SIGKILL", pgid)
+
+
+def process_start(pid):
+    """Start time of process pid (in clock ticks since boot), or None
+    if there is no such process.
+    """
+    for other, fields in _processes():
+        if other == pid:
+            return int(fields[19])
+    return None
+
+
+def _same_group(pgid, start):
+    """Whether process group pgid still exists and is the one whose
+    leader started at start.  Once the leader has exited, no new
+    process can be given its ID while others of its group live on.
+    """
+    members = [(pid, fields) for pid, fields in _processes()
+               if int(fields[2]) == pgid]
+    for pid, fields in members:
+        if pid == pgid:
+            return int(fields[19]) == start
+    return bool(members)
+
+
+def _group_alive(pgid):
+    """Whether process group pgid has any member but zombies; reaps
+    its leader if it is a zombie child of ours.
+    """
+    try:
+        os.waitpid(pgid, os.WNOHANG)
+    except ChildProcessError:
+        pass   # Not our child, or already reaped
+    return any(int(fields[2]) == pgid and fields[0] != "Z"
+               for _, fields in _processes())
+
+
+def _processes():
+    """(pid, fields of /proc/pid/stat after the command name) for
+    each process now running.
+    """
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            continue   # Process has gone
+        # Fields after the command name, which may contain spaces
+        yield int(entry), stat[stat.rindex(")") + 2:].split()
+
+
+def group_usage():
+    """Resource use by process group, read from /proc: a dict from
+    pgid to {"processes", "rss_bytes", "cpu_seconds"}.
+    """
+    page = os.sysconf("SC_PAGE_SIZE")
+    ticks = os.sysconf("SC_CLK_TCK")
+    usage = {}
+    for _, fields in _processes():
+        pgid = int(fields[2])
+        group = usage.setdefault(pgid, {"processes": 0, "rss_bytes": 0,
+                                        "cpu_seconds": 0.0})
+        group["processes"] += 1
+        group["rss_bytes"] += int(fields[21]) * page
+        group["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / ticks
+    return usage
@@ -0,0 +1,126 @@
+"""
+Which queued trial runs next.
+
+Each job has a priority class, one of PRIORITIES, best first:
+"instructor" (uploads from the instructor's addresses, e.g., while
+grading), "local" (from the lab network or the checker's own
+machine), and "remote" (students anywhere else).  The next job is
+taken from the best class that has a job queued and fewer than its
+cap of jobs running (a cap of 0 is no limit), so the instructor goes
+first without taking every worker away from students.
+
+Within a class, workers are shared fairly among authors: the next
+job is that of the author with the fewest jobs of the class running,
+and among those, the one whose last job started longest ago (or who
+has had none), and then the job that has waited longest.  A student
+who submits ten times in a row thus waits behind everyone else's
+trial instead of holding up the queue, and the wait of any one
+student is bounded by the number of students ahead, not the number
+of submissions.
+
+The functions here only choose; jobs.py keeps the queue, and calls
+them with its lock held.
+"""
+
+import collections
+import ipaddress
+
+import logging
+log = logging.getLogger(__name__)
+
+PRIORITIES = ["instructor", "local", "remote"]
+# Jobs of each class that may run at once, unless settings say
+MAX_RUNNING = {"instructor": 1, "local": 0, "remote": 0}
+LOCAL_ADDRESSES = "127.0.0.0/8, ::1"
+
+
+def priority_for(settings, address):
+    """Priority class of a submission from client address, with
+    settings (e.g., app.config) listing INSTRUCTOR_ADDRESSES and
+    LOCAL_ADDRESSES (comma separated; addresses may be networks,
+    e.g., 10.0.0.0/8).  Only the address counts: the author named in
+    the credentials is whatever the student chose to write there.
+    """
+    if _within(address, settings.get("INSTRUCTOR_ADDRESSES")):
+        return "instructor"
+    if _within(address, settings.get("LOCAL_ADDRESSES", LOCAL_ADDRESSES)):
+        return "local"
+    return "remote"
+
+
+def caps_for(settings):
+    """Jobs of each class that may run at once, from <class>_MAX_RUNNING
+    in settings or else MAX_RUNNING.
+    """
+    return {priority: settings.get(priority.upper() + "_MAX_RUNNING",
+                                   MAX_RUNNING[priority])
+            for priority in PRIORITIES}
+
+
+def pick(queued, running, caps, served):
+    """The job to run next, of queued (job dicts, longest waiting
+    first), given the jobs now running and when each (class, author)
+    last had a job started (served, e.g., a sequence number); None
+    if every class with a job queued is at its cap.
+    """
+    by_author = collections.Counter((job["priority"], job["author"])
+                                    for job in running)
+    by_class = collections.Counter(job["priority"] for job in running)
+    for priority in PRIORITIES:
+        cap = caps.get(priority)
+        if cap and by_class[priority] >= cap:
+            continue
+        candidates = [job for job in queued if job["priority"] == priority]
+        if candidates:
+            # Fewest running, then served least recently; min() keeps
+            # the first of equals, the one waiting longest
+            return min(candidates,
+                       key=lambda job: (by_author[priority, job["author"]],
+                                        served.get((priority, job["author"]),
+                                                   0)))
+    return None
+
+
+def order(queued, running, caps, served):
+    """queued (as for pick) in the order they are expected to start,
+    supposing that the jobs running finish one at a time, first
+    started first, and each frees a worker for the next job.
+    """
+    running = sorted(running, key=lambda job: job["started"])
+    slots = max(1, len(running))
+    served = dict(served)
+    clock = max(served.values(), default=0)
+    waiting = list(queued)
+    ordered = []
+    while waiting:
+        if len(running) >= slots:
+            running.pop(0)
+        job = (pick(waiting, running, caps, served)
+               or pick(waiting, running, {}, served))
+        waiting.remove(job)
+        ordered.append(job)
+        running.append(job)
+        clock += 1
+        served[job["priority"], job["author"]] = clock
+    return ordered
+
+
+def _listed(value):
+    """The items of a comma separated setting, as a list."""
+    return [item.strip() for item in str(value or "").split(",")
+            if item.strip()]
+
+
+def _within(address, networks):
+    """Whether address is one of networks (a comma separated setting)."""
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    for network in _listed(networks):
+        try:
+            if address in ipaddress.ip_network(network, strict=False):
+                return True
+        except ValueError:
+            log.warning("Not an address or network: %s", network)
+    return False
@@ -0,0 +1,131 @@
+"""
+State shared between processes.
+
+Under gunicorn there may be several worker processes, each with its
+own copy of every module global.  State that all of them must agree
+on (caches, counters, leases) is therefore kept in small files, and
+updated while holding an exclusive lock on a companion lock file.
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+PRUNE_EVERY = 3600   # Seconds between prunings of one directory
+
+
+@contextlib.contextmanager
+def locked(path, blocking=True):
+    """Hold an exclusive lock on path + ".lock" for the duration of
+    the with-block.  With blocking=False, yields False (instead of
+    waiting) if some other process holds the lock, else True.
+    """
+    lock_path = path + ".lock"
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.asynccontextmanager
+async def locked_async(path, poll=0.1):
+    """As locked(path), in an async with-block: waits for the lock by
+    trying again every poll seconds, so the event loop is not blocked.
+    """
+    while True:
+        with locked(path, blocking=False) as got_it:
+            if got_it:
+                yield
+                return
+        await asyncio.sleep(poll)
+
+
+def read_json(path, default=None):
+    """Contents of a JSON file, or default if it is missing or garbled."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, value):
+    """Replace the contents of a JSON file atomically."""
+    tmp = "{}.{}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def updating(path, default=None):
+    """Read a JSON file under lock, let the with-block modify the
+    value (which must be a dict or list), and write it back.
+    """
+    with locked(path):
+        value = read_json(path, default)
+        yield value
+        write_json(path, value)
+
+
+def tree_size(path):
+    """Total bytes in files under path (not following symlinks)."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def prune(directory, max_age, every=PRUNE_EVERY):
+    """Remove the files under directory last modified more than
+    max_age seconds ago (lock files aside), unless some process has
+    done so in the last every seconds.  Returns how many it removed.
+    """
+    stamp = os.path.join(directory, ",pruned")
+    now = time.time()
+    try:
+        if os.stat(stamp).st_mtime > now - every:
+            return 0
+    except FileNotFoundError:
+        if not os.path.isdir(directory):
+            return 0
+    with locked(stamp, blocking=False) as got_it:
+        if not got_it:
+            return 0
+        with open(stamp, "w"):
+            pass
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith(".lock") or path == stamp:
+                    continue
+                try:
+                    if os.lstat(path).st_mtime < now - max_age:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+    if removed:
+        log.info("Pruned %s files from %s", removed, directory)
+    return removed
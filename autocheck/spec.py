@@ -0,0 +1,111 @@
+"""
+Declarative test specifications for projects.
+
+Rather than a hand-written test.sh for each project, a project's
+tests directory may hold a spec.ini describing the test:
+
+   [trial]
+   # Files from the tests directory to copy into the clone
+   copy = sample_site -> sample_site
+          test_credentials.ini -> pageserver/credentials.ini
+   # Command that starts the server, run in the clone;
+   # {port} is replaced by the port leased for this trial
+   start = bash ./start.sh -P {port}
+   # Optional: virtual environment (in the clone) to run it in
+   venv = env
+
+   [sample page]
+   path = /simple_page.html
+   status = 200
+   body = Simple page          (optional regular expression)
+
+Every section other than [trial] is an HTTP check (see probe.py).
+The checker copies the files, starts the server on the port it has
+leased, waits for the server to accept connections, and then runs
+the checks concurrently.
+"""
+
+import configparser
+import os
+import shlex
+import shutil
+import subprocess
+
+import probe
+
+import logging
+log = logging.getLogger(__name__)
+
+SERVER_LOG = ",server.log"   # Server output, in the clone
+
+
+def read(path):
+    """The spec in the file at path, as a dict with "copy" (a list of
+    (source, destination) pairs), "start" (argument list, with
+    {port} still in it), "venv" (or None), and "checks".
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    trial = config["trial"]
+    copies = []
+    for line in trial.get("copy", "").splitlines():
+        if line.strip():
+            source, destination = line.split("->")
+            copies.append((source.strip(), destination.strip()))
+    return {"copy": copies,
+            "start": shlex.split(trial["start"]),
+            "venv": trial.get("venv") or None,
+            "checks": [probe.check_from(name, config[name])
+                       for name in config.sections() if name != "trial"]}
+
+
+def copy_files(spec, test_path, clone):
+    """Copy the spec's files from test_path into clone.  Returns
+    a line of description for each.
+    """
+    lines = []
+    for source, destination in spec["copy"]:
+        source_path = os.path.join(test_path, source)
+        destination_path = os.path.join(clone, destination)
+        if os.path.isdir(source_path):
+            shutil.copytree(source_path, destination_path,
+                            dirs_exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            shutil.copyfile(source_path, destination_path)
+        lines.append("Copied {} to {}".format(source, destination))
+    return lines
+
+
+def start_server(spec, clone, port, confinement=None):
+    """Start the server as the spec says, in its own session so that
+    it and its children can be found (and stopped) together, and
+    under the resource limits of confinement (a limits.Confinement),
+    if given.  Output goes to SERVER_LOG in the clone.  Returns the
+    subprocess.Popen.
+    """
+    args = [arg.format(port=port) for arg in spec["start"]]
+    if confinement:
+        args = confinement.command(args)
+    env = dict(os.environ)
+    if spec["venv"]:
+        venv = os.path.join(clone, spec["venv"])
+        env["VIRTUAL_ENV"] = venv
+        env["PATH"] = os.path.join(venv, "bin") + os.pathsep + env["PATH"]
+    log.debug("Starting server: %s in %s", args, clone)
+    with open(os.path.join(clone, SERVER_LOG), "ab") as output:
+        return subprocess.Popen(args, cwd=clone, env=env,
+                                stdin=subprocess.DEVNULL,
+                                stdout=output, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+
+def server_output(clone, limit=4096):
+    """The last limit characters the server has written."""
+    try:
+        with open(os.path.join(clone, SERVER_LOG), "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - limit))
+            return f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return ""
@@ -0,0 +1,108 @@
+"""
+Bounded capture of a log.
+
+A verbose 'make install' or a chatty student server can produce
+megabytes of output, which we must neither hold in memory (several
+times over) nor paste whole into a web page.  A Spool keeps only the
+first and last parts of the text in memory, enough to show what
+happened, and writes the complete text to a gzip-compressed file
+from which the full log can be downloaded.
+"""
+
+import collections
+import gzip
+import os
+
+import logging
+log = logging.getLogger(__name__)
+
+HEAD = 32 * 1024   # Characters kept from the beginning
+TAIL = 32 * 1024   # Characters kept from the end
+
+
+class Spool:
+    """Head-and-tail buffer over a log, with the whole log
+    optionally written compressed to path.  With head=None
+    everything is kept in memory.
+    """
+
+    def __init__(self, path=None, head=HEAD, tail=TAIL):
+        self.path = path
+        self.head_cap = head
+        self.tail_cap = tail
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.total = 0
+        self.closed = False
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, text):
+        """Add text to the log."""
+        if not text:
+            return
+        self.total += len(text)
+        if self._file:
+            self._file.write(text)
+        if self.head_cap is None:
+            room = len(text)
+        else:
+            room = self.head_cap - self.head_size
+        if room > 0:
+            self.head.append(text[:room])
+            self.head_size += len(text[:room])
+            text = text[room:]
+        if text:
+            text = text[-self.tail_cap:]
+            self.tail.append(text)
+            self.tail_size += len(text)
+            while self.tail_size - len(self.tail[0]) >= self.tail_cap:
+                self.tail_size -= len(self.tail.popleft())
+
+    @property
+    def truncated(self):
+        """Has some of the log been left out of text()?"""
+        return self.total > self.head_size + min(self.tail_size,
+                                                 self.tail_cap)
+
+    def text(self):
+        """The log, with the middle elided if it was too long."""
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        omitted = self.total - len(head) - len(tail)
+        if omitted <= 0:
+            return head + tail
+        # The oldest tail chunk may reach back further than we keep
+        tail = tail[-self.tail_cap:]
+        omitted = self.total - len(head) - len(tail)
+        return ("{}\n\n[... {} characters omitted; see the full log ...]"
+                "\n\n{}".format(head, omitted, tail))
+
+    def fork(self, suffix):
+        """A new spool with the same limits, writing beside this one."""
+        path = "{}.{}".format(self.path, suffix) if self.path else None
+        return Spool(path, self.head_cap, self.tail_cap)
+
+    def absorb(self, other):
+        """Append the whole of other (a closed fork) to this log,
+        and remove other's file.
+        """
+        if other.path:
+            with gzip.open(other.path, "rt", encoding="utf-8") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), ""):
+                    self.write(chunk)
+            os.remove(other.path)
+        else:
+            # Only head and tail survive without a file
+            self.write(other.text())
+
+    def close(self):
+        """Finish writing the file; the in-memory view remains."""
+        if self._file:
+            self._file.close()
+            self._file = None
+        self.closed = True
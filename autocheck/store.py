@@ -0,0 +1,177 @@
+"""
+Persistent record of trial jobs, in SQLite.
+
+jobs.py keeps jobs in the memory of the process that accepted them,
+and forgets them after a while.  Every job is also recorded here when
+it is submitted, started, and finished: who submitted it (author,
+repo, project), its stage results and timings, the port and server
+process it left running (and on which remote worker, if any), where
+its clone and full log are, and its messages.  So shutting a trial
+down (/_kill), the history page, and the instructor can find a job by
+ID, or a student's jobs by author, repo, or project, from any worker
+process and after a restart.
+
+The database is in WAL mode, so readers do not block the (short)
+writes, and writers from several gunicorn workers wait their turn
+for up to BUSY_SECONDS.  Each thread has its own connection.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+JOB_DB = "/tmp/,jobs/jobs.sqlite3"
+BUSY_SECONDS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    author TEXT,
+    repo TEXT,
+    project TEXT,
+    app TEXT,
+    status TEXT NOT NULL,
+    ok INTEGER,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    commit_id TEXT,
+    cached INTEGER,
+    workspace TEXT,
+    clone_path TEXT,
+    port TEXT,
+    server_pid INTEGER,
+    log_path TEXT,
+    log_truncated INTEGER,
+    stages TEXT,
+    messages TEXT,
+    worker TEXT,
+    host TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_by_author ON jobs (author, submitted);
+CREATE INDEX IF NOT EXISTS jobs_by_repo ON jobs (repo, submitted);
+CREATE INDEX IF NOT EXISTS jobs_by_project ON jobs (project, submitted);
+"""
+
+# Columns history() leaves out: where things are on this machine
+PRIVATE = ["workspace", "clone_path", "server_pid", "log_path"]
+
+# Columns added since the table was first created: (name, type)
+_ADDED = [("worker", "TEXT"), ("host", "TEXT")]
+
+_local = threading.local()
+
+
+def connection(path=JOB_DB):
+    """This thread's connection to the database at path, created
+    (with its schema) on first use.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        db = sqlite3.connect(path, timeout=BUSY_SECONDS,
+                             isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(_SCHEMA)
+        columns = [row["name"]
+                   for row in db.execute("PRAGMA table_info(jobs)")]
+        for name, kind in _ADDED:
+            if name not in columns:
+                try:
+                    db.execute("ALTER TABLE jobs ADD COLUMN {} {}"
+                               .format(name, kind))
+                except sqlite3.OperationalError as e:
+                    # Another process may have just added it
+                    log.debug("Could not add column %s: %s", name, e)
+        connections[path] = db
+    return connections[path]
+
+
+def submitted(job_id, context, when, path=JOB_DB):
+    """Record a newly queued job."""
+    connection(path).execute(
+        "INSERT OR REPLACE INTO jobs"
+        " (id, author, repo, project, app, status, submitted, workspace)"
+        " VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+        (job_id, context.get("author"), context.get("repo_remote"),
+         context.get("project"), context.get("app"), when,
+         context.get("workspace")))
+
+
+def started(job_id, when, path=JOB_DB):
+    """Record that a worker has taken up the job."""
+    connection(path).execute(
+        "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+        (when, job_id))
+
+
+def finished(job_id, context, ok, status, when, path=JOB_DB):
+    """Record the outcome of a job, from its trial context."""
+    connection(path).execute(
+        "UPDATE jobs SET status = ?, ok = ?, finished = ?, author = ?,"
+        " repo = ?, commit_id = ?, cached = ?, clone_path = ?, port = ?,"
+        " server_pid = ?, log_path = ?, log_truncated = ?, stages = ?,"
+        " messages = ?, worker = ?, host = ? WHERE id = ?",
+        (status, None if ok is None else bool(ok), when,
+         context.get("author"), context.get("repo_remote"),
+         context.get("commit"), bool(context.get("cached")),
+         context.get("clone_path"), context.get("port"),
+         context.get("server_pid"), context.get("log_path"),
+         bool(context.get("log_truncated")),
+         json.dumps(context.get("stages", {})),
+         context.get("messages"), context.get("worker"),
+         context.get("host"), job_id))
+
+
+def get(job_id, path=JOB_DB):
+    """The record of job_id as a dict (stages decoded), or None."""
+    row = connection(path).execute(
+        "SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _record(row) if row else None
+
+
+def history(author=None, repo=None, project=None, ids=None, limit=100,
+            path=JOB_DB):
+    """Most recent jobs first, optionally only those of author, repo,
+    and/or project, and/or with one of ids; without messages or the
+    paths and processes of this machine (PRIVATE).
+    """
+    conditions = []
+    values = []
+    if ids is not None:
+        conditions.append("id IN ({})".format(", ".join("?" * len(ids))))
+        values.extend(ids)
+    for column, value in [("author", author), ("repo", repo),
+                          ("project", project)]:
+        if value:
+            conditions.append("{} = ?".format(column))
+            values.append(value)
+    query = "SELECT * FROM jobs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY submitted DESC LIMIT ?"
+    values.append(limit)
+    records = []
+    for row in connection(path).execute(query, values):
+        record = _record(row)
+        for column in ["messages"] + PRIVATE:
+            del record[column]
+        records.append(record)
+    return records
+
+
+def _record(row):
+    record = dict(row)
+    record["stages"] = json.loads(record["stages"] or "{}")
+    for flag in ("ok", "cached", "log_truncated"):
+        if record[flag] is not None:
+            record[flag] = bool(record[flag])
+    return record
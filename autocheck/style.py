@@ -0,0 +1,105 @@
+"""
+PEP 8 style checking with pycodestyle, in process, with a cache.
+
+Running the pycodestyle command for each trial costs an interpreter
+start-up and a full check of every file, although between one
+submission and the next a student typically changes only a file or
+two.  Here we check through pycodestyle's Python API, and remember
+the findings for each file under a hash of its contents and of the
+style options in effect, so an unchanged file costs only a hash and
+a lookup.  The report has the same form as the command line tool's:
+   path:row:col: CODE text
+Findings not used for STYLE_KEEP_DAYS are removed by the reaper (see
+trial.reap_expired).
+"""
+
+import hashlib
+import json
+import os
+
+import pycodestyle
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+STYLE_CACHE_DIR = "/tmp/,stylecache"
+STYLE_KEEP_DAYS = 30
+
+# Options that change what pycodestyle reports for a file
+_KEY_OPTIONS = ["select", "ignore", "max_line_length", "max_doc_length",
+                "hang_closing", "indent_size", "indent_char"]
+
+
+class _Collector(pycodestyle.BaseReport):
+    """Report that remembers findings instead of printing them."""
+
+    def init_file(self, filename, lines, expected, line_offset):
+        self.found = []
+        return super().init_file(filename, lines, expected, line_offset)
+
+    def error(self, line_number, offset, text, check):
+        code = super().error(line_number, offset, text, check)
+        if code:
+            self.found.append((self.line_offset + line_number, offset + 1,
+                               code, text[5:]))
+        return code
+
+
+def check_tree(root, cache_dir=STYLE_CACHE_DIR):
+    """Check the Python files under root as 'pycodestyle root' would,
+    taking options from the same configuration files.  Returns
+    (report lines, number of files checked, number of cache hits).
+    """
+    guide = pycodestyle.StyleGuide(paths=[root], reporter=_Collector)
+    options_key = _options_key(guide.options)
+    lines = []
+    checked = hits = 0
+    for path in _python_files(guide, root):
+        with open(path, "rb") as f:
+            content = f.read()
+        key = hashlib.sha256(options_key + content).hexdigest()
+        cached = os.path.join(cache_dir, key[:2], key + ".json")
+        found = shared.read_json(cached)
+        if found is None:
+            guide.input_file(path)
+            found = sorted(guide.options.report.found)
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            shared.write_json(cached, found)
+        else:
+            hits += 1
+            try:
+                os.utime(cached)   # Recently used, so not pruned
+            except OSError:
+                pass
+        checked += 1
+        for row, col, code, text in found:
+            lines.append("{}:{}:{}: {} {}".format(path, row, col, code, text))
+    log.debug("Style checked %s files under %s, %s from cache",
+              checked, root, hits)
+    return lines, checked, hits
+
+
+def _python_files(guide, root):
+    """The files under root that pycodestyle would check, in order."""
+    root = root.rstrip("/")
+    if guide.excluded(root):
+        return
+    patterns = guide.options.filename
+    for dirpath, dirnames, filenames in os.walk(root):
+        for subdir in sorted(dirnames):
+            if guide.excluded(subdir, dirpath):
+                dirnames.remove(subdir)
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if (pycodestyle.filename_match(filename, patterns) and
+                    not guide.excluded(filename, dirpath)):
+                yield os.path.join(dirpath, filename)
+
+
+def _options_key(options):
+    """Bytes identifying pycodestyle's version and relevant options."""
+    settings = {name: getattr(options, name, None) for name in _KEY_OPTIONS}
+    return json.dumps([pycodestyle.__version__, settings], sort_keys=True,
+                      default=sorted).encode("utf-8")
@@ -14,34 +14,107 @@ may also be augmented, but success can be silent. If the step fails
 or we encounter an unexpected error), then the step returns
 False and the context["messages"] field is definitely augmented.
 
-For each project, we expect two scripts in test/projX : 
+For each project, we expect in tests/projX either
+  spec.ini, a declarative description of the test: files to copy,
+  the command that starts the server, and HTTP checks (see spec.py),
+  or
   test.sh <proj-path> <portnum> starts server, runs any automated tests, 
-  leaves server running for manual tests. 
+  leaves server running for manual tests.  If there is also a
+  checks.ini, the HTTP checks it lists are made after test.sh.
+and in either case
   cleanup.sh stops server, deletes anything that needs deleting. 
-  test.sh may also leave a time-bomb for destroying the test
-  process after K minutes (tentatively 10). 
+  Servers left running for manual tests are stopped, and the clone
+  removed, by shutdown or after SANDBOX_TTL seconds (see sandbox.py).
 Requirements (assumptions) about the structure of student projects
 is in ../README.md --- we impose this common structure so that we 
 can factor much of the manipulation out of start.sh and cleanup.sh
 to here.  
+
+The steps are coroutines, run in an asyncio event loop: commands are
+asyncio subprocesses (see runner.run_async), waiting for a server
+to start is an asyncio connection attempt, and the few blocking
+calls (style check, HTTP checks, copying files) run in a pool of
+TRIAL_THREADS worker threads (see in_thread).  So one event loop
+can supervise many trials at once, each a trial_async task;
+cancelling the task kills the trial's commands and releases its
+sandbox.  trial() and shutdown() run one trial (or shutdown) to
+completion in an event loop of their own, for callers that are not
+asynchronous.
 """
 
+import asyncio
+import concurrent.futures
 import configparser
+import functools
 import os
 import arrow
-import random
+import shutil
 import subprocess
+import threading
+import time
+
+import envcache
+import events
+import limits
+import mirrors
+import ports
+import probe
+import results
+import runner
+import sandbox
+import shared
+import spec
+import spool
+import style
+import workspace
 
 import logging
-logging.basicConfig(format='%(levelname)s:%(message)s',
-                    level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
 CRED_FIELDS = ["author", "repo"]
 
+LOG_DIR = "/tmp/,logs"   # Full logs of trials, compressed
+LOG_KEEP_DAYS = 14
+
+# Blocking calls of all trials in this process share a pool of threads
+TRIAL_THREADS = 16
+_pool = None
+_pool_lock = threading.Lock()
+
+# Grader settings (upper case, as in config.py); see configure()
+SETTINGS = {}
+
+
+def configure(settings):
+    """Adopt grader settings, e.g., the Flask app.config built by
+    config.py.  Settings not given keep their defaults.
+    """
+    SETTINGS.update(settings)
+
+
+async def in_thread(function, *args, **kwargs):
+    """function(*args, **kwargs), run in the pool of TRIAL_THREADS
+    threads (see configure) shared by the trials in this process,
+    rather than the event loop's default executor, which is sized
+    by the number of CPUs.  Cancelling it does not stop function.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                SETTINGS.get("TRIAL_THREADS", TRIAL_THREADS),
+                thread_name_prefix="trial-blocking")
+    return await asyncio.get_running_loop().run_in_executor(
+        _pool, functools.partial(function, *args, **kwargs))
+
 
 def trial(context):
+    """Run trial_async(context) to completion; returns its result."""
+    return asyncio.run(trial_async(context))
+
+
+async def trial_async(context):
     """
     Initially we expect the context dict to contain two fields:
     "credentials" is the .ini file that includes, among other things,
@@ -49,33 +122,250 @@ def trial(context):
     "messages" is where we place log output, including error messages.
     Successful steps need not add to the messages, but failures
     must always add explanatory messages.
+    A "clone_path" (which must not exist, or be an empty directory)
+    may also be given; otherwise we clone into the "workspace" (see
+    workspace.py) given, or into a new one.
+    If the same commit has been tried before with the same tests,
+    we report the earlier result (see results.py) unless the context
+    has a true "fresh" field.  A "head" field, the commit at HEAD of
+    the repository if the caller has just found it, saves asking
+    the repository again.
     """
     log.debug("Entering trial")
-    log.debug("Context: {}".format(context))
     settings = read_config(context["credentials"])
-    log.debug("Configuration settings: {}".format(settings))
+    log.debug("Configuration settings: %s", settings)
     repo_remote = settings["repo"]
-    clone_path = tmp_path("clone")
+    clone_path = context.get("clone_path")
+    if not clone_path:
+        if "workspace" not in context:
+            context["workspace"] = await in_thread(new_workspace)
+        clone_path = os.path.join(context["workspace"], "clone")
+    context["author"] = settings["author"]
     context["repo_remote"] = repo_remote
     context["clone_path"] = clone_path
+    trace(context, "trial_start", project=context["project"],
+          repo=repo_remote, fresh=bool(context.get("fresh")))
+    started = time.time()
 
-    log.debug("Preparing to clone and install")
+    if await in_thread(cached_result, context):
+        if "workspace" in context:
+            workspace.finish(context["workspace"])
+        trace(context, "trial_end", ok=context["ok"], cached=True,
+              commit=context.get("commit"))
+        return context["ok"]
 
-    ok = (clone_repo(context)
-              and install(context))
+    log.debug("Preparing to clone and install")
+    sandbox.register(lease_holder(context), clone_path,
+                     registry=SETTINGS.get("SANDBOX_REGISTRY",
+                                           sandbox.REGISTRY),
+                     project=context["project"],
+                     repo=repo_remote,
+                     workspace=context.get("workspace"))
 
-    # The following steps are contingent only on passing
-    # installation, i.e., we run tests even if style check fails
-    if ok:
-          ok = stylecheck(context)
-          ok = testit(context) and ok 
+    # Messages go to a bounded spool from here on; the full log
+    # is kept compressed at log_path
+    log_path = os.path.join(SETTINGS.get("LOG_DIR", LOG_DIR),
+                            "{}.log.gz".format(lease_holder(context)
+                                               .replace("/", "_")))
+    context["log_path"] = log_path
+    context["spool"] = spool.Spool(
+        log_path,
+        head=SETTINGS.get("LOG_HEAD_KB", spool.HEAD // 1024) * 1024,
+        tail=SETTINGS.get("LOG_TAIL_KB", spool.TAIL // 1024) * 1024)
+    context["spool"].write(context["messages"])
+    try:
+        # See STAGES: style check and tests are contingent only on
+        # passing installation, i.e., we run tests even if style check
+        # fails, and the two run concurrently
+        ok = await run_stages(context, STAGES)
+    except asyncio.CancelledError:
+        trace(context, "trial_cancelled")
+        await in_thread(release, lease_holder(context))
+        raise
+    finally:
+        log_spool = context.pop("spool")
+        log_spool.close()
+        context["messages"] = log_spool.text()
+        context["log_truncated"] = log_spool.truncated
+        context["output_bytes"] = log_spool.total
+        # Left running for trying by hand, for so long from now
+        sandbox.finish(lease_holder(context),
+                       ttl=SETTINGS.get("SANDBOX_TTL", sandbox.TTL),
+                       registry=SETTINGS.get("SANDBOX_REGISTRY",
+                                             sandbox.REGISTRY))
+    await in_thread(remember_result, context, ok)
+    trace(context, "trial_end", ok=ok, cached=False,
+          commit=context.get("commit"), seconds=time.time() - started,
+          output_bytes=context["output_bytes"])
 
     log.debug("Returned from trial")
-    log.debug("Log messages: {}".format(context["messages"]))
 
     return ok
 
+
+def result_key(context, commit):
+    """Key for the result of trying commit in this context, with
+    the credentials file uploaded for it.
+    """
+    this_dir = os.path.dirname(__file__)
+    test_path = os.path.join(this_dir,  "..", "tests", context["project"])
+    return results.key(context["repo_remote"], commit,
+                       context["project"], context["app"],
+                       results.suite_version(test_path),
+                       results.credentials_version(context["credentials"]))
+
+
+def cached_result(context):
+    """If we have a result for the commit now at the head of the
+    repository, put it in the context and return True.
+    """
+    if context.get("fresh") or not SETTINGS.get("RESULT_CACHE", True):
+        return False
+    # The upload handler may have found it already
+    commit = context.get("head") or results.remote_head(
+        context["repo_remote"])
+    context["commit"] = commit
+    if commit is None:
+        return False
+    result = results.lookup(
+        result_key(context, commit),
+        result_dir=SETTINGS.get("RESULT_DIR", results.RESULT_DIR))
+    if result is None:
+        return False
+    log.debug("Cached result for %s at %s",
+              context["repo_remote"], commit)
+    when = arrow.get(result["stored"]).to("local").format(
+        "YYYY-MM-DD HH:mm:ss")
+    note(context, "\n*** CACHED RESULT: commit {} was already checked at {}."
+                  "\n*** Push new commits, or ask for a fresh trial,"
+                  " to run it again.\n".format(commit[:10], when))
+    note(context, result["messages"])
+    context["ok"] = result["ok"]
+    context["stages"] = result["stages"]
+    context["log_path"] = result.get("log_path")
+    context["log_truncated"] = result.get("log_truncated", False)
+    context["cached"] = True
+    return True
+
+
+def remember_result(context, ok):
+    """Store the result of a trial under the commit that was tried,
+    unless it may not be the commit's own (see uncertain).
+    """
+    if not SETTINGS.get("RESULT_CACHE", True):
+        return
+    if context.get("uncertain"):
+        log.debug("Not remembering result (%s)", context["uncertain"])
+        return
+    commit = results.checked_out(context["clone_path"])
+    if commit is None:
+        return
+    context["commit"] = commit
+    results.store(
+        result_key(context, commit),
+        {"ok": bool(ok),
+         "commit": commit,
+         "messages": context["messages"],
+         "stages": context.get("stages", {}),
+         "log_truncated": context.get("log_truncated", False)},
+        log_path=context.get("log_path"),
+        result_dir=SETTINGS.get("RESULT_DIR", results.RESULT_DIR))
+
+
+async def run_stages(context, stages):
+    """Run stages, each a tuple (name, step coroutine function, names
+    of stages it depends on), as a small dependency graph.  A stage
+    runs only if all the stages it depends on succeeded; stages that
+    become ready together run concurrently, as tasks in the event
+    loop, each with its own copy of the context.
+    Their messages, and the context entries each added or changed,
+    are merged back in the order the stages are listed, so the log
+    reads the same no matter which stage finishes first.  Returns True
+    if every stage ran and succeeded.
+
+    The outcome of each stage is recorded in context["stages"], a dict
+    from stage name to {"ok": result, "seconds": wall-clock time}, with
+    "ok" None for a stage skipped because a dependency failed.
+    """
+    results = {}
+    record = context.setdefault("stages", {})
+    pending = list(stages)
+    while pending:
+        ready = [stage for stage in pending
+                 if all(dep in results for dep in stage[2])]
+        if not ready:
+            raise ValueError("Stage dependencies cannot be satisfied: {}"
+                             .format([stage[0] for stage in pending]))
+        pending = [stage for stage in pending if stage not in ready]
+        runnable = []
+        for name, step, deps in ready:
+            if all(results[dep] for dep in deps):
+                runnable.append((name, step))
+            else:
+                log.debug("Skipping stage %s", name)
+                results[name] = False
+                record[name] = {"ok": None, "seconds": 0.0}
+        if not runnable:
+            continue
+        if len(runnable) == 1:
+            name, step = runnable[0]
+            results[name] = await timed_step(name, step, context)
+            continue
+        runs = []
+        try:
+            for name, step in runnable:
+                stage_context = dict(context, messages="")
+                if "spool" in context:
+                    stage_context["spool"] = context["spool"].fork(name)
+                runs.append((name, step, stage_context))
+            before = dict(context)
+            outcomes = await asyncio.gather(
+                *[timed_step(name, step, stage_context)
+                  for name, step, stage_context in runs],
+                return_exceptions=True)
+            for (name, step, stage_context), outcome in zip(
+                    runs, outcomes):
+                if isinstance(outcome, BaseException):
+                    raise outcome
+                results[name] = outcome
+                context["messages"] += stage_context["messages"]
+                # Only what the stage changed, lest its copy of a value
+                # undo another stage's change
+                context.update(
+                    {key: value for key, value in stage_context.items()
+                     if key not in ("messages", "spool")
+                     and (key not in before or value is not before[key])})
+        finally:
+            # Whatever happened, each fork's output joins the log
+            for name, step, stage_context in runs:
+                stage_spool = stage_context.pop("spool", None)
+                if stage_spool:
+                    stage_spool.close()
+                    context["spool"].absorb(stage_spool)
+    return all(results.values())
+
+
+async def timed_step(name, step, context):
+    """Run step(context) (a coroutine function), recording its result
+    and wall-clock time in context["stages"][name].  Returns the
+    result.
+    """
+    trace(context, "stage_start", stage=name)
+    started = time.time()
+    ok = await step(context)
+    seconds = time.time() - started
+    context.setdefault("stages", {})[name] = {
+        "ok": bool(ok), "seconds": seconds}
+    trace(context, "stage_end", stage=name, ok=bool(ok), seconds=seconds)
+    return ok
+
+
 def shutdown(context):
+    """Run shutdown_async(context) to completion; returns its result."""
+    return asyncio.run(shutdown_async(context))
+
+
+async def shutdown_async(context):
     """
     After trial, and after a pause for manual testing, we 
     try to clean up. 
@@ -86,26 +376,164 @@ def shutdown(context):
     this_dir = os.path.dirname(__file__)
     test_path = os.path.join(this_dir,  "..", "tests", project)
     test_script = os.path.join(test_path, "cleanup.sh")
-    log.debug("Looking for shutdown script at {}".format(test_path))
-    context["messages"] = "\n*** Shutting down ***\n"
+    log.debug("Looking for shutdown script at %s", test_path)
+    context["messages"] = ""
+    note(context, "\n*** Shutting down ***\n")
     testlog = "*** Call to subprocess shutdown.sh did not complete ***"
     try:
-        testlog = subprocess.check_output(
-            [test_script, clone],
-            cwd=test_path,
-            stderr=subprocess.STDOUT,
-            # encoding='utf-8' )       # Not supported in Python 3.4
-            universal_newlines=True)   # but this is?
-        context["messages"] += testlog
-        log.debug("Shutdown output: {}".format(testlog))
+        testlog = await command(context, [test_script, clone], "cleanup",
+                                cwd=test_path)
         return True
-    except subprocess.CalledProcessError as exception:
-        log.error("Cleanup failed: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += testlog
-        context["messages"] += exception.output
+    except (subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as exception:
+        log.error("Cleanup failed: %s", exception)
+        log.debug("Output: %s", exception.output)
+        note(context, testlog)
+        note_limit(context, limits.describe(exception))
         return False
+    finally:
+        await in_thread(release, lease_holder(context))
+
+
+def release(holder):
+    """Stop the processes of a trial, remove its clone, give up its
+    port, and let its workspace go.
+    """
+    released = sandbox.release(
+        holder, registry=SETTINGS.get("SANDBOX_REGISTRY", sandbox.REGISTRY))
+    if released and released.get("workspace"):
+        workspace.finish(released["workspace"])
+    ports.release(holder,
+                  lease_file=SETTINGS.get("PORT_LEASE_FILE", ports.LEASE_FILE))
+
+
+def reap_expired():
+    """Release every trial whose sandbox has outlived its time to
+    live (see sandbox.py), then remove finished workspaces as needed
+    to stay within quota (see workspace.py), and files kept longer
+    than their settings say (see prune).
+    """
+    registry = SETTINGS.get("SANDBOX_REGISTRY", sandbox.REGISTRY)
+    for holder in sandbox.expired(registry=registry):
+        log.info("Reaping expired trial %s", holder)
+        events.emit(holder, "reaped",
+                    trace_dir=SETTINGS.get("TRACE_DIR", events.TRACE_DIR))
+        release(holder)
+    limits.sweep(limits.for_stage("server", SETTINGS))
+    workspace.collect(
+        root=SETTINGS.get("WORKSPACE_DIR", workspace.WORKSPACE_DIR),
+        quota_mb=SETTINGS.get("WORKSPACE_QUOTA_MB", workspace.QUOTA_MB),
+        max_age_hours=SETTINGS.get("WORKSPACE_MAX_AGE_HOURS",
+                                   workspace.MAX_AGE_HOURS))
+    prune(SETTINGS.get("LOG_DIR", LOG_DIR),
+          SETTINGS.get("LOG_KEEP_DAYS", LOG_KEEP_DAYS))
+    prune(SETTINGS.get("TRACE_DIR", events.TRACE_DIR),
+          SETTINGS.get("TRACE_KEEP_DAYS", events.TRACE_KEEP_DAYS))
+    prune(SETTINGS.get("RESULT_DIR", results.RESULT_DIR),
+          SETTINGS.get("RESULT_KEEP_DAYS", results.RESULT_KEEP_DAYS))
+    prune(SETTINGS.get("STYLE_CACHE_DIR", style.STYLE_CACHE_DIR),
+          SETTINGS.get("STYLE_KEEP_DAYS", style.STYLE_KEEP_DAYS))
+
+
+def prune(directory, keep_days):
+    """Remove files in directory older than keep_days (see
+    shared.prune); neither an empty directory setting nor 0 days
+    removes anything.
+    """
+    if directory and keep_days:
+        shared.prune(directory, keep_days * 24 * 3600)
+
+
+def track_process(context, process):
+    """Register a process (leading its own group) with the trial's
+    sandbox, so that it is stopped when the trial is shut down.
+    """
+    sandbox.add_group(lease_holder(context), process.pid,
+                      registry=SETTINGS.get("SANDBOX_REGISTRY",
+                                            sandbox.REGISTRY))
+
+
+def note(context, text):
+    """Add text to the messages of context, and pass it on at once to
+    the context's "listener" function, if it has one, e.g., to
+    stream it to the browser while the trial is still running.
+    During a trial the messages are gathered in context["spool"]
+    (see spool.py), and become context["messages"] at the end.
+    """
+    log_spool = context.get("spool")
+    if log_spool is not None:
+        log_spool.write(text)
+    else:
+        context["messages"] += text
+    listener = context.get("listener")
+    if listener:
+        listener(text)
+
 
+async def command(context, args, stage, cwd=None, tracked=False):
+    """Run a command (see runner.run_async) under the resource limits of
+    stage (see limits.py), noting its output in context line by line
+    as it is produced.  Returns the output; raises
+    subprocess.CalledProcessError (limits.LimitExceeded if it broke
+    a limit) or subprocess.TimeoutExpired on failure, but the output
+    is in the messages either way.  Cancelling it kills the command.
+    A tracked command may leave processes running (e.g., a server);
+    it runs in a session of its own, registered with the sandbox.
+    The command, its exit status, and its duration are traced.
+    """
+    trace(context, "command_start", stage=stage, argv=args, cwd=cwd)
+    started = time.time()
+    outcome = {"exit": None, "limit": None}
+    try:
+        output = await runner.run_async(
+            args, cwd=cwd,
+            emit=lambda text: note(context, text),
+            keep=spool.HEAD + spool.TAIL,
+            new_session=tracked,
+            limits=limits.for_stage(stage, SETTINGS),
+            on_start=(lambda process: track_process(context, process))
+            if tracked else None)
+        outcome["exit"] = 0
+        return output
+    except subprocess.CalledProcessError as exception:
+        outcome.update(exit=exception.returncode,
+                       limit=limits.describe(exception))
+        if outcome["limit"]:
+            uncertain(context, outcome["limit"])
+        raise
+    except subprocess.TimeoutExpired as exception:
+        outcome.update(limit=limits.describe(exception))
+        uncertain(context, outcome["limit"])
+        raise
+    finally:
+        trace(context, "command_end", stage=stage, argv=args,
+              seconds=time.time() - started, **outcome)
+
+
+def uncertain(context, reason):
+    """Note that the outcome of the trial may be down to the checker
+    or its load (e.g., a time limit), not the commit alone, so that
+    it is not remembered as the commit's result (see remember_result).
+    """
+    context["uncertain"] = reason
+
+
+def trace(context, event, **fields):
+    """Record an event in the trace of this context's trial (see
+    events.py).
+    """
+    events.emit(lease_holder(context), event,
+                trace_dir=SETTINGS.get("TRACE_DIR", events.TRACE_DIR),
+                **fields)
+
+
+def note_limit(context, reason):
+    """If a command failed by breaking a resource limit (reason,
+    as from limits.describe), say so plainly, apart from any other
+    failure.
+    """
+    if reason:
+        note(context, "\n*** Stopped: exceeded the {} ***\n".format(reason))
 
 
 def read_config(path):
@@ -118,157 +546,316 @@ def read_config(path):
     return settings
 
 
-def clone_repo(context):
+async def clone_repo(context):
     """Attempt to clone the repository"""
     log.debug("Entering clone_repo")
     clone_path = context["clone_path"]
     repo_remote = context["repo_remote"]
-    context["messages"] += "\n*** Cloning ***\n"
+    note(context, "\n*** Cloning ***\n")
     try:
-        installation = subprocess.check_output(
-            ["git", "clone", repo_remote, clone_path],
-            stderr=subprocess.STDOUT,
-            # encoding='utf-8')        # Not supported in Python 3.4
-            universal_newlines=True)   # But this is?
-        log.info("Installation messages: {}".format(installation))
-        context["messages"] += installation
-        listing = subprocess.check_output(
-            ["ls", "-p", "-C", "-B",  clone_path],
-            stderr=subprocess.STDOUT,
-            # encoding='utf-8' )       # Not supported in Python 3.4
-            universal_newlines=True)   # but this is?
-        context["messages"] += listing
+        installation = None
+        if SETTINGS.get("MIRROR_CACHE_MB", mirrors.MIRROR_CACHE_MB):
+            installation = await clone_from_mirror(repo_remote, clone_path)
+            if installation is not None:
+                note(context, installation)
+        if installation is None:
+            installation = await command(
+                context, ["git", "clone", repo_remote, clone_path], "clone")
+        await command(context, ["ls", "-p", "-C", "-B",  clone_path],
+                      "clone")
         return True
-    except subprocess.CalledProcessError as exception:
-        log.error("Installation failed: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += exception.output
+    except (subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as exception:
+        log.error("Installation failed: %s", exception)
+        log.debug("Output: %s", exception.output)
+        note_limit(context, limits.describe(exception))
         return False
 
 
-def install(context):
+async def clone_from_mirror(repo_remote, clone_path):
+    """Clone by way of the local mirror cache (see mirrors.py).
+    Returns the git output, or None if the mirror could not be used,
+    in which case the caller should clone directly from the remote.
+    Raises subprocess.TimeoutExpired or limits.LimitExceeded if git
+    broke a limit, as a direct clone would too.
+    """
+    cache_dir = SETTINGS.get("MIRROR_DIR", mirrors.MIRROR_DIR)
+    try:
+        gitlog = await mirrors.clone(
+            repo_remote, clone_path, cache_dir=cache_dir,
+            limits=limits.for_stage("clone", SETTINGS))
+    except limits.LimitExceeded:
+        raise
+    except (subprocess.CalledProcessError, OSError) as exception:
+        log.warning("Mirror clone failed, cloning directly: %s",
+                    exception)
+        await in_thread(shutil.rmtree, clone_path, ignore_errors=True)
+        return None
+    await in_thread(
+        mirrors.evict, cache_dir,
+        SETTINGS.get("MIRROR_CACHE_MB", mirrors.MIRROR_CACHE_MB),
+        keep=mirrors.mirror_path(repo_remote, cache_dir))
+    return gitlog
+
+
+async def install(context):
     """Installation includes copying the credentials file
-    and calling the Makefile installation recipe.
+    and calling the Makefile installation recipe.  If a virtual
+    environment for the same requirements.txt is cached (see
+    envcache.py), we use a copy of it instead.
     """
     log.debug("Entering install")
     clone = context["clone_path"]
-    log.debug("Working in directory {}".format(clone))
-    makelog = "\n*** Installing ***\n"
+    log.debug("Working in directory %s", clone)
+    note(context, "\n*** Installing ***\n")
     try:
         cred_file_path = os.path.join(context["app"], "credentials.ini")
-        makelog += subprocess.check_output(
-            ["cp", context["credentials"], cred_file_path],
-            cwd=clone,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True)
-        makelog += "** Contents of application sub-folder **\n"
-        makelog += subprocess.check_output(
-            ["ls", "-p", "-C", "-B",  context["app"]], 
-            cwd=clone,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True)
-        makelog += subprocess.check_output(
-            ["make", "install"],
-            cwd=clone,
-            stderr=subprocess.STDOUT,
-            # encoding='utf-8' )       # Not supported in Python 3.4
-            universal_newlines=True)   # but this is
-        context["messages"] += makelog
-        log.debug("Make output: {}".format(makelog))
+        await command(context,
+                      ["cp", context["credentials"], cred_file_path],
+                      "install", cwd=clone)
+        note(context, "** Contents of application sub-folder **\n")
+        await command(context, ["ls", "-p", "-C", "-B",  context["app"]],
+                      "install", cwd=clone)
+        if await in_thread(restore_env, clone):
+            note(context, "(Virtual environment for this requirements.txt"
+                          " restored from cache; checking the recipe"
+                          " without running it)\n")
+            await command(context, ["make", "-n", "install"], "install",
+                          cwd=clone)
+            return True
+        await command(context, ["make", "install"], "install", cwd=clone)
+        await save_env(clone)
         return True
-    except subprocess.CalledProcessError as exception:
-        log.error("Installation failed: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += makelog
-        context["messages"] += "Encountered exception"
-        # context["messages"] += str(exception.output)
-        context["messages"] += str("Exception: {}".format(exception))
+    except (subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as exception:
+        log.error("Installation failed: %s", exception)
+        log.debug("Output: %s", exception.output)
+        note(context, "Encountered exception")
+        note(context, str("Exception: {}".format(exception)))
+        note_limit(context, limits.describe(exception))
+        return False
+
+
+def restore_env(clone):
+    """Copy a cached virtual environment for the clone's requirements
+    into the clone, if there is one; returns True if so.
+    """
+    if not SETTINGS.get("VENV_CACHE_MB", envcache.VENV_CACHE_MB):
+        return False
+    try:
+        return envcache.restore(
+            clone,
+            cache_dir=SETTINGS.get("VENV_CACHE_DIR", envcache.VENV_CACHE_DIR))
+    except (subprocess.CalledProcessError, OSError) as exception:
+        log.warning("Could not restore environment: %s", exception)
+        shutil.rmtree(os.path.join(clone, "env"), ignore_errors=True)
         return False
 
 
-def testit(context):
+async def save_env(clone):
+    """Build and cache a virtual environment for the clone's
+    requirements (see envcache.populate), if none is cached.
+    """
+    if not SETTINGS.get("VENV_CACHE_MB", envcache.VENV_CACHE_MB):
+        return
+    cache_dir = SETTINGS.get("VENV_CACHE_DIR", envcache.VENV_CACHE_DIR)
+    try:
+        await envcache.populate(clone, cache_dir=cache_dir,
+                                limits=limits.for_stage("install", SETTINGS))
+        await in_thread(
+            envcache.evict, cache_dir,
+            SETTINGS.get("VENV_CACHE_MB", envcache.VENV_CACHE_MB),
+            keep=envcache.entry_path(clone, cache_dir))
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+            OSError) as exception:
+        log.warning("Could not cache environment: %s", exception)
+
+
+async def testit(context):
     log.debug("Entering testit")
     clone = context["clone_path"]
     project = context["project"]
     this_dir = os.path.dirname(__file__)
     test_path = os.path.join(this_dir,  "..", "tests", project)
     test_script = os.path.join(test_path, "test.sh")
-    port = choose_port()
+    port = choose_port(lease_holder(context))
     context["port"] = port
+    if port is None:
+        note(context, "\n*** No free port for testing ***\n")
+        uncertain(context, "no free port")
+        return False
     assert isinstance(port,str), "Port should be in string form"
-    log.debug("Will run on port {}".format(port))
+    log.debug("Will run on port %s", port)
+
+    if os.path.exists(os.path.join(test_path, "spec.ini")):
+        note(context, "\n*** Testing ***\n")
+        ok = await run_spec(context, test_path, port)
+        note(context, "\n*Automated tests complete*\n")
+        return ok
 
-    log.debug("Looking for test script at {}".format(test_path))
-    context["messages"] += "\n*** Testing ***\n"
+    log.debug("Looking for test script at %s", test_path)
+    note(context, "\n*** Testing ***\n")
     testlog = "*** Call to subprocess test.sh did not complete ***"
     try:
-        log.debug("Args: {}".format([test_script, clone, port]))
-        testlog = subprocess.check_output(
-            [test_script, clone, port],
-            cwd=test_path,
-            stderr=subprocess.STDOUT,
-            timeout=15,
-            # encoding='utf-8' )       # Not supported in Python 3.4
-            universal_newlines=True)   # but this is?
-        testlog += "\n*Automated tests complete*\n"
-        context["messages"] = testlog
-        log.debug("Testing output: {}".format(testlog))
-        return True
+        testlog = await command(context, [test_script, clone, port],
+                                "test", cwd=test_path, tracked=True)
+        log.debug("Testing output: %s", testlog)
     except subprocess.TimeoutExpired as exception:
-        log.error("Testing timed out: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += testlog
-        context["messages"] += exception.output
+        log.error("Testing timed out: %s", exception)
+        log.debug("Output: %s", exception.output)
+        note(context, testlog)
+        note_limit(context, limits.describe(exception))
         return False
     except subprocess.CalledProcessError as exception:
-        log.error("Testing failed: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += testlog
-        context["messages"] += exception.output
+        log.error("Testing failed: %s", exception)
+        log.debug("Output: %s", exception.output)
+        note(context, testlog)
+        note_limit(context, limits.describe(exception))
+        return False
+    ok = await http_checks(context, test_path, port)
+    note(context, "\n*Automated tests complete*\n")
+    return ok
+
+
+async def run_spec(context, test_path, port):
+    """Test as described by the project's spec.ini (see spec.py):
+    copy files into the clone, start the server on port, wait for
+    it to accept connections, and run the checks.
+    """
+    clone = context["clone_path"]
+    try:
+        test_spec = spec.read(os.path.join(test_path, "spec.ini"))
+        copied = await in_thread(spec.copy_files, test_spec,
+                                 test_path, clone)
+        for line in copied:
+            note(context, line + "\n")
+        confinement = limits.Confinement(limits.for_stage("server",
+                                                          SETTINGS))
+        server = spec.start_server(test_spec, clone, port,
+                                   confinement=confinement)
+    except (OSError, KeyError, ValueError) as exception:
+        log.error("Could not start test: %s", exception)
+        note(context, "Could not start server: {}\n".format(exception))
+        uncertain(context, "server not started")
+        return False
+    context["server_pid"] = server.pid
+    track_process(context, server)
+    trace(context, "server_start", argv=test_spec["start"], pid=server.pid,
+          port=port)
+    note(context, "Started server (process {}) on port {}\n"
+                  .format(server.pid, port))
+    seconds = SETTINGS.get("PROBE_SECONDS", probe.PROBE_SECONDS)
+    waited = await probe.wait_for_port(
+        port, seconds=seconds,
+        give_up=lambda: server.poll() not in (None, 0))
+    if waited is None:
+        note(context, "\n*** Server did not accept connections on port {}"
+                      " within {} seconds (exit status {}) ***\n"
+                      .format(port, seconds, server.poll()))
+        reason = confinement.breach(server.poll(), spec.server_output(clone))
+        note_limit(context, reason)
+        trace(context, "server_failed", exit=server.poll(), limit=reason)
+        uncertain(context, reason or "server not ready")
+        ok = False
+    else:
+        note(context, "\n*** Server ready after {:.1f} seconds;"
+                      " checking responses ***\n".format(waited))
+        trace(context, "server_ready", seconds=waited)
+        results = await in_thread(probe.run_checks, port,
+                                  test_spec["checks"])
+        note(context, "".join(line + "\n"
+                              for line in probe.report(results)))
+        ok = all(result["ok"] for result in results)
+        if any(result["error"] for result in results):
+            uncertain(context, "no response")
+        trace(context, "checks", passed=sum(r["ok"] for r in results),
+              failed=sum(not r["ok"] for r in results))
+    note(context, "\nServer diagnostic output:\n")
+    note(context, spec.server_output(clone))
+    return ok
+
+
+async def http_checks(context, test_path, port):
+    """If the project's tests include checks.ini, wait for the server
+    started by test.sh to accept connections, then make the HTTP
+    requests listed there (see probe.py).  Returns True if all pass.
+    """
+    checks_file = os.path.join(test_path, "checks.ini")
+    if not os.path.exists(checks_file):
+        return True
+    checks = probe.read_checks(checks_file)
+    seconds = SETTINGS.get("PROBE_SECONDS", probe.PROBE_SECONDS)
+    waited = await probe.wait_for_port(port, seconds=seconds)
+    if waited is None:
+        note(context, "\n*** Server did not accept connections on port {}"
+                      " within {} seconds ***\n".format(port, seconds))
+        uncertain(context, "server not ready")
         return False
+    note(context, "\n*** Server ready after {:.1f} seconds;"
+                  " checking responses ***\n".format(waited))
+    results = await in_thread(probe.run_checks, port, checks)
+    note(context, "".join(line + "\n" for line in probe.report(results)))
+    if any(result["error"] for result in results):
+        uncertain(context, "no response")
+    return all(result["ok"] for result in results)
 
 
-def stylecheck(context):
+async def stylecheck(context):
+    """PEP 8 check of the whole clone, in process (see style.py)."""
     log.debug("Entering stylecheck")
     clone = context["clone_path"]
-    project = context["project"]
-    this_dir = os.path.dirname(__file__)
-    test_path = os.path.join(this_dir,  "..", "tests", project)
-    log.debug("Attempting pycodestyle script at {}".format(test_path))
     testlog = "\n*** PEP 8 standards check ***\n"
     try:
-        testlog = subprocess.check_output(
-            ["pycodestyle", clone],
-            cwd=test_path,
-            stderr=subprocess.STDOUT,
-            # encoding='utf-8' )       # Not supported in Python 3.4
-            universal_newlines=True)   # but this is?
-        context["messages"] += testlog
-        log.debug("Style check output: {}".format(testlog))
-        return True
-    except subprocess.CalledProcessError as exception:
-        log.error("Checking failed: {}".format(exception))
-        log.error("Output: {}".format(exception.output))
-        context["messages"] += testlog
-        context["messages"] += exception.output
+        report, checked, cached = await in_thread(
+            style.check_tree, clone,
+            cache_dir=SETTINGS.get("STYLE_CACHE_DIR", style.STYLE_CACHE_DIR))
+    except (OSError, SyntaxError, ValueError) as exception:
+        log.error("Checking failed: %s", exception)
+        note(context, testlog)
+        note(context, "Style check failed: {}\n".format(exception))
         return False
-    
-def choose_port():
-    """Return as string a randomly selected port number in a range that 
-    is typically available to user processes, and avoiding those 
-    typically used by default in flask and gunicorn.  Not guaranteed to 
-    be currently available  (this might be fixed in the future if 
-    it turns out to be a problem). 
+    log.debug("Style check output: %s", report)
+    note(context, testlog)
+    note(context, "".join(line + "\n" for line in report))
+    return not report
+
+
+def choose_port(holder):
+    """Return as string a port number leased to holder (see ports.py),
+    in a range that is typically available to user processes, and
+    avoiding those typically used by default in flask and gunicorn.
+    The port was free when leased, and no other trial will be given
+    it until the lease is released by shutdown or expires.  Returns
+    None if no port is available.
     """
-    port = random.randrange(8500,9999)
+    port = ports.lease(
+        holder,
+        low=SETTINGS.get("PORT_LOW", ports.PORT_LOW),
+        high=SETTINGS.get("PORT_HIGH", ports.PORT_HIGH),
+        seconds=SETTINGS.get("PORT_LEASE_SECONDS", ports.LEASE_SECONDS),
+        lease_file=SETTINGS.get("PORT_LEASE_FILE", ports.LEASE_FILE))
+    if port is None:
+        return None
     return str(port)
 
 
-def tmp_path(name, dir="/tmp"):
-    """Return a unique local path in /tmp based on name."""
-    # While Python's UUID module could do this,
-    # we don't need universal uniqueness, so a shorter
-    # name based on timestamp will do.  Leading comma
-    # encourages daily cleanup.
-    ts = arrow.now().timestamp
-    return "{}/,{}.{}".format(dir, name[0:8], ts)
+def lease_holder(context):
+    """Ports and other per-trial resources are held in the name of the
+    job if there is one, else the clone directory.
+    """
+    return context.get("job_id") or context["clone_path"]
+
+
+# Stages of a trial: (name, step, names of stages it depends on)
+STAGES = [("clone", clone_repo, []),
+          ("install", install, ["clone"]),
+          ("stylecheck", stylecheck, ["install"]),
+          ("testit", testit, ["install"])
+          ]
+
+
+def new_workspace():
+    """A new workspace directory (see workspace.py) for a trial."""
+    return workspace.allocate(
+        root=SETTINGS.get("WORKSPACE_DIR", workspace.WORKSPACE_DIR),
+        quota_mb=SETTINGS.get("WORKSPACE_QUOTA_MB", workspace.QUOTA_MB))
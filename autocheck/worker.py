@@ -0,0 +1,241 @@
+"""
+Remote trial worker: runs trials for the checker's web server (the
+coordinator), on another machine or in another process, so that the
+web server need not run them all itself.
+
+Usage (from the autocheck directory):
+   python3 worker.py --coordinator http://checker.local:8000
+Options:
+   --coordinator URL  base URL of the web server
+   -C config.ini      configuration; its worker_token must match the
+                      web server's.  Trial settings (limits, caches,
+                      ports, ...) are those of this machine.
+   -j N               trials to run at once (default 1)
+   --name NAME        name of this worker (default host name and
+                      process ID)
+   --host HOST        name by which students can reach servers left
+                      running here (default the host name)
+
+Each of the N slots asks the coordinator for a job (waiting a while
+for one, see jobs.claim), runs the trial with trial.trial_async, sends
+the output so far with a heartbeat every HEARTBEAT_SECONDS, and then
+sends the result: the trial context, the full log, and the trace
+events.  If the coordinator answers that the job is no longer ours
+(it heard nothing for too long and gave the job to another worker),
+the trial is cancelled, or released if it has already finished.
+Servers left running for manual testing are shut down when the
+coordinator passes on a request to (/_kill), or reaped after
+sandbox_ttl, as on the web server.
+
+The protocol is JSON over HTTP on the local network, with the shared
+worker_token as the only credential.  Several workers may run on one
+machine (e.g., to try it out on localhost); they share port leases
+and sandboxes through the same files, as web server threads do.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import urllib.error
+import urllib.request
+
+import config
+import events
+import grade
+import jobs
+import sandbox
+import trial
+
+import logging
+log = logging.getLogger(__name__)
+
+HEARTBEAT_SECONDS = 5
+RETRY_SECONDS = 5    # After the coordinator could not be reached
+RESULT_TRIES = 5
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(
+        description="CIS 322 Auto-Checker: remote trial worker")
+    parser.add_argument("--coordinator", required=True,
+                        help="Base URL of the checker's web server")
+    parser.add_argument("-C", "--config", default="config.ini",
+                        help="Configuration file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of trials to run at once")
+    parser.add_argument("--name", default=None,
+                        help="Name of this worker")
+    parser.add_argument("--host", default=socket.gethostname(),
+                        help="Host name for reaching servers left running")
+    return parser.parse_args()
+
+
+class Coordinator:
+    """The web server, as seen by a worker named name."""
+
+    def __init__(self, url, token, name):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.name = name
+
+    def post(self, path, body, timeout=60):
+        """POST body (a dict, to which our name is added) as JSON to
+        path.  Returns (HTTP status, decoded reply), or (None, None)
+        if the coordinator could not be reached.
+        """
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(dict(body, worker=self.name)).encode("utf-8"),
+            headers={"Content-Type": "application/json",
+                     "X-Worker-Token": self.token})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as reply:
+                return reply.status, json.load(reply)
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except (OSError, ValueError) as e:
+            log.warning("Could not reach coordinator at %s: %s",
+                        self.url, e)
+            return None, None
+
+
+async def serve(coordinator, host):
+    """One slot: claim and run jobs forever."""
+    while True:
+        status, reply = await asyncio.to_thread(
+            coordinator.post, "/_worker/claim",
+            {"wait": jobs.CLAIM_WAIT}, timeout=jobs.CLAIM_WAIT + 30)
+        if status != 200:
+            if status not in (None, 503):   # 503: nothing to do yet
+                log.error("Coordinator refused claim (HTTP %s)", status)
+            await asyncio.sleep(RETRY_SECONDS)
+            continue
+        for request in reply["shutdown"]:
+            log.info("Shutting down job %s", request["job_id"])
+            await trial.shutdown_async(dict(request, messages=""))
+        if reply["job"]:
+            await run_job(coordinator, reply["job"], host)
+
+
+async def run_job(coordinator, job, host):
+    """Run a claimed job, with heartbeats, and report its result."""
+    job_id = job["id"]
+    log.info("Running job %s", job_id)
+    job_workspace = await asyncio.to_thread(trial.new_workspace)
+    credentials = os.path.join(job_workspace, "credentials.ini")
+    with open(credentials, "w") as f:
+        f.write(job["credentials"])
+    output = []
+    context = {"credentials": credentials,
+               "workspace": job_workspace,
+               "messages": "",
+               "project": job["project"],
+               "app": job["app"],
+               "fresh": job["fresh"],
+               "head": job.get("head"),
+               "job_id": job_id,
+               "host": host,
+               "listener": output.append}
+    running = asyncio.create_task(trial.trial_async(context))
+    while not running.done():
+        await asyncio.wait([running], timeout=HEARTBEAT_SECONDS)
+        status = await heartbeat(coordinator, job_id, output)
+        if status == 409 and not running.done():
+            log.warning("Job %s is no longer ours; cancelling", job_id)
+            running.cancel()
+    try:
+        ok = running.result()
+        final = "done"
+    except asyncio.CancelledError:
+        return   # trial_async has released it
+    except Exception as e:
+        log.error("Job %s raised %s", job_id, e)
+        trial.note(context, "\n*** Checker failed: {} ***\n".format(e))
+        ok = False
+        final = "error"
+    body = {"ok": bool(ok),
+            "status": final,
+            "context": {name: context[name] for name in jobs.RESULT_FIELDS
+                        if name in context},
+            "log": await asyncio.to_thread(read_log, context.get("log_path")),
+            "events": trace_of(job_id)}
+    for attempt in range(RESULT_TRIES):
+        status, _ = await asyncio.to_thread(
+            coordinator.post, "/_worker/{}/result".format(job_id), body)
+        if status == 200:
+            log.info("Finished job %s: %s", job_id, final)
+            return
+        if status == 409:
+            break
+        await asyncio.sleep(RETRY_SECONDS)
+    log.warning("Result of job %s not taken; releasing it", job_id)
+    await asyncio.to_thread(trial.release, trial.lease_holder(context))
+
+
+async def heartbeat(coordinator, job_id, output):
+    """Tell the coordinator job_id is still running, passing on (and
+    clearing) the output since the last heartbeat.  Returns the HTTP
+    status; output not delivered is kept for the next heartbeat.
+    """
+    sent = len(output)
+    status, _ = await asyncio.to_thread(
+        coordinator.post, "/_worker/{}/heartbeat".format(job_id),
+        {"output": "".join(output[:sent])})
+    if status is not None:
+        del output[:sent]
+    return status
+
+
+def trace_of(job_id):
+    """The trace events of job_id here, as recorded."""
+    trace = events.timeline(
+        job_id, trace_dir=trial.SETTINGS.get("TRACE_DIR", events.TRACE_DIR))
+    for event in trace:
+        del event["offset"]
+    return trace
+
+
+def read_log(log_path):
+    """The compressed log at log_path, in base64, or None."""
+    if not log_path:
+        return None
+    try:
+        with open(log_path, "rb") as f:
+            return base64.b64encode(f.read()).decode("ascii")
+    except OSError as e:
+        log.warning("Could not read log %s: %s", log_path, e)
+        return None
+
+
+async def work(coordinator, host, slots):
+    await asyncio.gather(*[serve(coordinator, host) for _ in range(slots)])
+
+
+def main():
+    args = command_line_args()
+    settings = grade.settings_from(args.config)
+    config.configure_logging(settings)
+    token = str(settings.get("WORKER_TOKEN") or "")
+    if not token:
+        log.error("No worker_token in %s; the coordinator would refuse us",
+                  args.config)
+        return 1
+    trial.configure(settings)
+    sandbox.start_reaper(every=settings.get("REAP_EVERY", sandbox.REAP_EVERY),
+                         reap=trial.reap_expired)
+    name = args.name or "{}-{}".format(socket.gethostname(), os.getpid())
+    coordinator = Coordinator(args.coordinator, token, name)
+    log.info("Worker %s taking jobs from %s, %s at a time",
+             name, args.coordinator, args.jobs)
+    try:
+        asyncio.run(work(coordinator, args.host, args.jobs))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,101 @@
+"""
+Workspaces: one directory per trial, for the uploaded credentials and
+the clone.
+
+Each workspace is a fresh directory under WORKSPACE_DIR with a random
+name, so that submissions arriving in the same instant cannot collide.
+A workspace is in use until finish() marks it finished (when its
+trial has been shut down or reaped, see trial.release, or when the
+result came from the cache), noting its size then.  Finished
+workspaces are kept until space is needed: collect(), run now and
+then by the reaper (see trial.reap_expired), removes finished
+workspaces, oldest first, while the total exceeds the quota.
+Workspaces left unfinished for longer than MAX_AGE_HOURS (e.g., by a
+worker process that died) count as finished.  If the workspaces in
+use alone exceeded the quota when last collected, allocate() raises
+QuotaExceeded rather than let /tmp fill up; allocating does not
+itself look through the workspaces.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import shared
+
+import logging
+log = logging.getLogger(__name__)
+
+WORKSPACE_DIR = "/tmp/,work"
+QUOTA_MB = 4000
+MAX_AGE_HOURS = 24
+FINISHED = ",finished"   # Marker file in a finished workspace, with size
+USAGE = ",usage.json"   # Total size when last collected
+
+
+class QuotaExceeded(OSError):
+    """No room for another workspace until some trials finish."""
+
+
+def allocate(name="job", root=WORKSPACE_DIR, quota_mb=QUOTA_MB):
+    """A new, empty workspace directory, named for name.  Raises
+    QuotaExceeded if the workspaces in use were over quota_mb when
+    last collected.
+    """
+    os.makedirs(root, exist_ok=True)
+    total = shared.read_json(os.path.join(root, USAGE), {}).get("bytes", 0)
+    if total > quota_mb * 1024 * 1024:
+        raise QuotaExceeded("Workspaces in use take {} MB of {} MB"
+                            .format(total // (1024 * 1024), quota_mb))
+    return tempfile.mkdtemp(prefix="{}.".format(name), dir=root)
+
+
+def finish(path):
+    """Mark the workspace at path finished; it may be removed later."""
+    try:
+        shared.write_json(os.path.join(path, FINISHED),
+                          {"bytes": shared.tree_size(path)})
+    except OSError as e:
+        log.warning("Could not mark workspace %s finished: %s",
+                    path, e)
+
+
+def collect(root=WORKSPACE_DIR, quota_mb=QUOTA_MB,
+            max_age_hours=MAX_AGE_HOURS):
+    """Remove finished (or stale) workspaces, oldest first, until the
+    total size is within quota_mb, and note the total for allocate().
+    Returns the total, in bytes.
+    """
+    with shared.locked(os.path.join(root, ",collect")):
+        finished = []
+        in_use = 0
+        stale = time.time() - max_age_hours * 3600
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.startswith(",") or not os.path.isdir(path):
+                continue
+            marker = os.path.join(path, FINISHED)
+            if os.path.exists(marker):
+                size = shared.read_json(marker, {}).get("bytes")
+                if size is None:
+                    size = shared.tree_size(path)
+                finished.append((os.stat(marker).st_mtime, path, size))
+            elif os.stat(path).st_mtime < stale:
+                finished.append((os.stat(path).st_mtime, path,
+                                 shared.tree_size(path)))
+            else:
+                in_use += shared.tree_size(path)
+        total = in_use + sum(size for _, _, size in finished)
+        cap = quota_mb * 1024 * 1024
+        for _, path, size in sorted(finished):
+            if total <= cap:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            log.info("Removed workspace %s (%s bytes)", path, size)
+        if total > cap:
+            log.warning("Workspaces in use take %s MB of %s MB",
+                        total // (1024 * 1024), quota_mb)
+        shared.write_json(os.path.join(root, USAGE), {"bytes": total})
+        return total
@@ -20,7 +20,9 @@ this=${BASH_SOURCE[0]}
 here=`dirname ${this}`
 source ${here}/env/bin/activate
 pushd autocheck
-gunicorn --bind="0.0.0.0:8000" flask_grader:app &
+# Threads, so that pages streaming trial output don't block other requests;
+# keep max_streams in config.ini well below the number of threads
+gunicorn --bind="0.0.0.0:8000" --threads=8 flask_grader:app &
 pid=$!
 popd
 echo ${pid} >SERVICE_PID